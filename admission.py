@@ -0,0 +1,128 @@
+import math
+import time
+from collections import deque
+
+RANDOM, MENTION, STREAMER, REDEEMER = 0, 1, 2, 3
+
+
+class AdmissionController:
+    """
+    Decides how much of the chat Sally answers, so answers keep arriving
+    within target_latency of the message even during raids.
+
+    It measures the incoming message rate, how long an answer takes to
+    generate and to speak, and how long viewers actually waited for their
+    answer. The chance to answer a random message is scaled down while
+    answers are late, and never goes beyond what Sally can keep up with.
+
+    Waiting messages are answered by priority, redeemers first, then the
+    streamer, then messages mentioning Sally. Redeemers are answered in turn,
+    everybody else newest first. Only redeemers wait as long as it takes, everything
+    else is just added to the conversation once it is older than
+    target_latency. Of the messages that are not answered only the newest
+    batch_size() per answer go into the conversation, so a burst does not
+    push all earlier context out of the window.
+
+    Args:
+    - answer_rate (int): Percent of random messages answered when chat is calm.
+    - target_latency (float): Seconds from a message to its answer that should not be exceeded.
+    - window (float): Seconds over which the message rate is measured.
+    - max_batch (int): The most unanswered messages added to the conversation per answer.
+    - min_probability (float): Random messages are never answered less often than this.
+    """
+
+    def __init__(self, answer_rate: int = 30, target_latency: float = 10.0, window: float = 30.0, max_batch: int = 10,
+                 min_probability: float = 0.01) -> None:
+        self.base_probability = answer_rate / 100
+        self.target_latency = target_latency
+        self.window = window
+        self.max_batch = max_batch
+        self.min_probability = min_probability
+        self.arrivals = deque()
+        self.started = time.monotonic()
+        self.completion_time = None  # smoothed seconds per completion
+        self.speech_time = None  # smoothed seconds spent speaking an answer
+        self.latency = None  # smoothed seconds from message to answer
+        self.scale = 1.0  # feedback factor on the answer probability
+
+    def arrived(self, now: float = None):
+        now = time.monotonic() if now is None else now
+        self.arrivals.append(now)
+        while self.arrivals and self.arrivals[0] < now - self.window:
+            self.arrivals.popleft()
+
+    def rate(self, now: float = None) -> float:
+        """
+        Returns:
+        - float: Messages per second over the last window.
+        """
+        now = time.monotonic() if now is None else now
+        while self.arrivals and self.arrivals[0] < now - self.window:
+            self.arrivals.popleft()
+        return len(self.arrivals) / max(min(self.window, now - self.started), 1.0)
+
+    def completed(self, seconds: float):
+        self.completion_time = seconds if self.completion_time is None else 0.7 * self.completion_time + 0.3 * seconds
+
+    def spoken(self, seconds: float):
+        self.speech_time = seconds if self.speech_time is None else 0.7 * self.speech_time + 0.3 * seconds
+
+    @property
+    def service_time(self) -> float:
+        # completions overlap with speaking, whichever is slower limits how many answers fit in
+        return max(self.completion_time or 0.0, self.speech_time or 0.0)
+
+    def responded(self, latency: float):
+        self.latency = latency if self.latency is None else 0.7 * self.latency + 0.3 * latency
+        if self.latency > self.target_latency:
+            self.scale = max(self.scale * 0.7, 0.01)
+        elif self.latency < 0.6 * self.target_latency:
+            self.scale = min(self.scale * 1.2, 1.0)
+
+    def answer_probability(self) -> float:
+        probability = self.base_probability * self.scale
+        rate = self.rate()
+        if self.service_time and rate > 0:
+            # at most as many answers as completions can keep up with, with some headroom
+            probability = min(probability, 0.8 / (self.service_time * rate))
+        return max(probability, min(self.min_probability, self.base_probability))
+
+    def batch_size(self) -> int:
+        if not self.service_time:
+            return self.max_batch
+        return max(1, min(self.max_batch, math.ceil(self.rate() * self.service_time)))
+
+    def stale(self, message, now: float) -> bool:
+        # redeemers paid for their answer, everybody else only gets one while it is still timely
+        if message.priority >= REDEEMER:
+            return False
+        return now - message.received_at > self.target_latency
+
+    def select(self, pending: list):
+        """
+        Splits the waiting messages, oldest first, into the one to answer
+        next, the ones to answer later, the ones only added to the
+        conversation and the ones dropped.
+
+        Returns:
+        - tuple: (message or None, keep, context, dropped), all lists in arrival order.
+        """
+        now = time.time()
+        answerable = []
+        context = []
+        for message in pending:
+            if message.answer and not self.stale(message, now):
+                answerable.append(message)
+            else:
+                message.answer = False
+                context.append(message)
+        chosen = None
+        if answerable:
+            top = max(message.priority for message in answerable)
+            candidates = [message for message in answerable if message.priority == top]
+            # redeemers in turn, everybody else newest first so answers stay fresh when chat is busy
+            chosen = candidates[0] if top >= REDEEMER else candidates[-1]
+        keep = [message for message in answerable if message is not chosen]
+        batch = self.batch_size()
+        dropped = context[:-batch] if len(context) > batch else []
+        return chosen, keep, context[len(dropped):], dropped
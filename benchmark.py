@@ -0,0 +1,325 @@
+"""
+Offline end to end benchmark of the chat pipeline.
+
+Drives main.QueueConsumer with synthetic chat: Twitch messages go through
+Bot.event_message, YouTube and Stream lines are appended to the exchange
+files like streamer.bot does. Completions come from a local fake OpenAI
+endpoint, speech goes to a local websocket sink that behaves like
+speaker.bot. Both fakes run in a child process so the CPU figures only
+cover the consumer.
+
+Every synthetic message carries an id (#123), the fake model answers with
+the id of the newest message in the conversation and the sink notes when
+it first hears it, which gives the end to end latency from the line being
+written to the answer going out to speaker.bot.
+
+    python benchmark.py --rates 1 10 100 500 --duration 10
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MESSAGE_ID = re.compile(r'#(\d+)')
+PHRASES = ('what game is this', 'how are you doing today', 'that jump was insane', 'do you like pizza',
+           'tell me a joke', 'what is your favourite color', 'good evening chat', 'is the boss hard',
+           'who is the best streamer', 'can you sing something')
+
+
+class FakeAuthor:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.display_name = name
+        self.is_mod = False
+        self._ws = None  # twitchio looks this up when building a command context
+
+
+class FakeChannel:
+    name = 'benchmark'
+
+
+class FakeTwitchMessage:
+    # just enough of twitchio.Message for Bot.event_message and handle_commands
+    def __init__(self, author: str, content: str) -> None:
+        self.author = FakeAuthor(author)
+        self.content = content
+        self.channel = FakeChannel()
+        self.echo = False
+        self.tags = {}
+        self.first = False
+        self.id = None
+
+
+def fake_reply(messages: list) -> str:
+    for message in reversed(messages):
+        if message.get('role') == 'user':
+            match = MESSAGE_ID.search(message.get('content', ''))
+            if match:
+                return f'Sally: Sure thing #{match.group(1)}, that is a great question. Thanks for asking, chat!'
+    return 'Sally: Hello everyone, nice to see you all here today. Enjoy the stream!'
+
+
+async def serve_openai(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, config: dict):
+    # minimal HTTP/1.1 with keep alive, enough for the openai client on /v1/chat/completions
+    try:
+        while True:
+            head = await reader.readuntil(b'\r\n\r\n')
+            lines = head.decode('latin-1').split('\r\n')
+            headers = {name.strip().lower(): value.strip() for name, _, value in (line.partition(':') for line in lines[1:] if line)}
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            request = json.loads(body or b'{}')
+            words = fake_reply(request.get('messages', [])).split(' ')
+            await asyncio.sleep(config['llm_latency'])
+            created = int(time.time())
+            if request.get('stream'):
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n')
+                for i, word in enumerate(words):
+                    chunk = {'id': 'bench', 'object': 'chat.completion.chunk', 'created': created, 'model': request.get('model'),
+                             'choices': [{'index': 0, 'delta': {'content': word if i == 0 else ' ' + word}, 'finish_reason': None}]}
+                    payload = f'data: {json.dumps(chunk)}\n\n'.encode()
+                    writer.write(f'{len(payload):x}\r\n'.encode() + payload + b'\r\n')
+                    await writer.drain()
+                    await asyncio.sleep(config['token_interval'])
+                payload = b'data: [DONE]\n\n'
+                writer.write(f'{len(payload):x}\r\n'.encode() + payload + b'\r\n0\r\n\r\n')
+            else:
+                await asyncio.sleep(config['token_interval'] * len(words))
+                response = {'id': 'bench', 'object': 'chat.completion', 'created': created, 'model': request.get('model'),
+                            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': ' '.join(words)}, 'finish_reason': 'stop'}],
+                            'usage': {'prompt_tokens': 0, 'completion_tokens': len(words), 'total_tokens': len(words)}}
+                payload = json.dumps(response).encode()
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+                             + f'Content-Length: {len(payload)}\r\n\r\n'.encode() + payload)
+            await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_speaker(websocket, config: dict, heard: dict, counts: dict):
+    from websockets.exceptions import ConnectionClosed
+    playing = asyncio.Lock()
+
+    async def play(packet):
+        async with playing:
+            await asyncio.sleep(len(packet['message']) / config['speech_cps'])
+            try:
+                await websocket.send(json.dumps({'event': {'source': 'General', 'type': 'SpeakCompleted'},
+                                                 'data': {'id': packet['id']}}))
+            except ConnectionClosed:
+                pass
+
+    async for raw in websocket:
+        packet = json.loads(raw)
+        await websocket.send(json.dumps({'id': packet.get('id'), 'status': 'ok'}))
+        if packet.get('request') != 'Speak':
+            continue
+        counts['packets'] += 1
+        match = MESSAGE_ID.search(packet['message'])
+        if match:
+            heard.setdefault(int(match.group(1)), time.time())
+        asyncio.create_task(play(packet))
+
+
+async def run_fakes_async(config: dict, ready, stop, results):
+    from websockets.asyncio.server import serve
+    heard = {}
+    counts = {'packets': 0}
+    openai_server = await asyncio.start_server(lambda r, w: serve_openai(r, w, config), '127.0.0.1', config['openai_port'])
+    async with serve(lambda ws: serve_speaker(ws, config, heard, counts), '127.0.0.1', config['speaker_port']):
+        ready.set()
+        while not stop.is_set():
+            await asyncio.sleep(0.05)
+    openai_server.close()
+    results.put({'heard': heard, 'packets': counts['packets'], 'cpu': time.process_time()})
+
+
+def run_fakes(config: dict, ready, stop, results):
+    asyncio.run(run_fakes_async(config, ready, stop, results))
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+def pick_platform(weights: dict) -> str:
+    return random.choices(list(weights), weights=list(weights.values()))[0]
+
+
+async def drive(args, rate: float, workdir: str) -> dict:
+    import main
+    from chat import CompletionClient, OpenAIBackend
+    from logger import Logger
+
+    l = Logger(console_log=args.verbose)
+    backend = OpenAIBackend(api_key='benchmark', base_url=f'http://127.0.0.1:{args.openai_port}/v1')
+    consumer = main.QueueConsumer(l, channel=FakeChannel.name, speaker_bot_port=args.speaker_port, answer_rate=args.answer_rate,
+                                  llm=CompletionClient(l, backend), stream_responses=not args.no_stream,
+                                  chars_per_second=args.speech_cps, prefetch_depth=args.prefetch)
+    bot = main.Bot(consumer, l)
+    with open(main.REDEEM_EXCHANGE, 'a', encoding='utf-8') as file:
+        file.write('benchmark;msg:benchmark started\n')
+    task = asyncio.create_task(consumer.main())
+    deadline = time.monotonic() + 10
+    while consumer.speaker.websocket is None or not consumer.is_redeemed:
+        if time.monotonic() > deadline:
+            raise RuntimeError('Consumer did not start, is the speaker port free?')
+        await asyncio.sleep(0.05)
+    consumer.cooldown = 10 ** 9  # stay enabled for the whole run
+
+    files = {'YouTube': main.CHAT_EXCHANGE, 'Stream': main.STREAMER_EXCHANGE}
+    total = max(int(rate * args.duration), 1)
+    sent = {}
+    cpu_start = time.process_time()
+    start = time.monotonic()
+    for i in range(total):
+        delay = start + i / rate - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        platform = pick_platform(args.platforms)
+        author = f'viewer{random.randrange(200)}'
+        content = f'{random.choice(PHRASES)} {"sally " if random.random() < args.mentions else ""}#{i}'
+        sent[i] = time.time()
+        if platform == 'Twitch':
+            await bot.event_message(FakeTwitchMessage(author, content))
+        else:
+            with open(files[platform], 'a', encoding='utf-8') as file:
+                file.write(f'{author};msg:{content}\n')
+    generated = time.monotonic() - start
+
+    drain_deadline = time.monotonic() + args.drain
+    while time.monotonic() < drain_deadline:
+        if not consumer.has_pending() and consumer.answers.empty() and not consumer.pacer.speaking:
+            break
+        await asyncio.sleep(0.1)
+    wall = time.monotonic() - start
+    cpu = time.process_time() - cpu_start
+    metrics = consumer.metrics
+    await consumer.close()
+    try:
+        await asyncio.wait_for(task, 10)
+    except asyncio.TimeoutError:
+        pass
+    counters = {label: value for (name, label), value in metrics.counters.items() if name == 'messages'}
+    return {'sent': total, 'sent_at': sent, 'generated': generated, 'wall': wall, 'cpu': cpu, 'counters': counters,
+            'stages': {stage: (h.count, h.sum / h.count if h.count else 0.0) for stage, h in metrics.stages.items()}}
+
+
+def run_rate(args, rate: float) -> dict:
+    workdir = tempfile.mkdtemp(prefix='sally-bench-')
+    for name in ('prompt_chat.txt', 'memory.txt'):
+        shutil.copy(os.path.join(HERE, name), workdir)
+    context = multiprocessing.get_context('spawn')
+    ready, stop, results = context.Event(), context.Event(), context.Queue()
+    config = {'openai_port': args.openai_port, 'speaker_port': args.speaker_port, 'llm_latency': args.llm_latency,
+              'token_interval': args.token_interval, 'speech_cps': args.speech_cps}
+    fakes = context.Process(target=run_fakes, args=(config, ready, stop, results), daemon=True)
+    fakes.start()
+    cwd = os.getcwd()
+    try:
+        if not ready.wait(10):
+            raise RuntimeError('Fake servers did not start')
+        os.chdir(workdir)
+        run = asyncio.run(drive(args, rate, workdir))
+    finally:
+        os.chdir(cwd)
+        stop.set()
+    fake_results = results.get(timeout=10)
+    fakes.join(5)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    latencies = [heard - run['sent_at'][i] for i, heard in fake_results['heard'].items() if i in run['sent_at']]
+    counters = run['counters']
+    received = counters.get('received', 0) - 1  # not counting the redeem line that enabled Sally
+    return {
+        'rate': rate,
+        'sent': run['sent'],
+        'achieved_rate': run['sent'] / run['generated'] if run['generated'] else float('inf'),
+        'received': received,
+        'lost': run['sent'] - received,
+        'dropped': counters.get('dropped', 0),
+        'ignored': counters.get('ignored', 0),
+        'answered': counters.get('answered', 0),
+        'answers_per_second': counters.get('answered', 0) / run['wall'],
+        'spoken_packets': fake_results['packets'],
+        'latency_p50': percentile(latencies, 0.5),
+        'latency_p95': percentile(latencies, 0.95),
+        'latency_p99': percentile(latencies, 0.99),
+        'cpu_percent': 100 * run['cpu'] / run['wall'],
+        'fakes_cpu_seconds': fake_results['cpu'],
+        'stages': run['stages'],
+    }
+
+
+def report(result: dict) -> str:
+    lines = [f"--- {result['rate']:g} msg/s: sent {result['sent']} at {result['achieved_rate']:.1f} msg/s",
+             f"    received {result['received']}  lost {result['lost']}  dropped {result['dropped']}  "
+             f"ignored {result['ignored']}  answered {result['answered']} ({result['answers_per_second']:.2f}/s)",
+             f"    end to end p50 {result['latency_p50'] * 1000:.0f}ms  p95 {result['latency_p95'] * 1000:.0f}ms  "
+             f"p99 {result['latency_p99'] * 1000:.0f}ms  consumer cpu {result['cpu_percent']:.1f}%"]
+    for stage, (count, mean) in sorted(result['stages'].items()):
+        lines.append(f'    {stage:<18} n={count:<6} mean {mean * 1000:.2f}ms')
+    return '\n'.join(lines)
+
+
+def parse_platforms(value: str) -> dict:
+    weights = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        if name not in ('Twitch', 'YouTube', 'Stream'):
+            raise argparse.ArgumentTypeError(f'Unknown platform {name}')
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='Offline end to end benchmark of the Sally chat pipeline.')
+    parser.add_argument('--rates', type=float, nargs='+', default=[1, 10, 50, 100, 250, 500], help='messages per second, one run each')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of chat per run')
+    parser.add_argument('--drain', type=float, default=15.0, help='seconds to wait for answers after the chat stopped')
+    parser.add_argument('--platforms', type=parse_platforms, default=parse_platforms('Twitch=1,YouTube=1,Stream=0.2'),
+                        help='platform weights, e.g. Twitch=1,YouTube=1,Stream=0.2')
+    parser.add_argument('--mentions', type=float, default=0.3, help='share of messages that mention sally')
+    parser.add_argument('--answer-rate', type=int, default=30, help='QueueConsumer answer_rate')
+    parser.add_argument('--prefetch', type=int, default=1, help='QueueConsumer prefetch_depth')
+    parser.add_argument('--no-stream', action='store_true', help='request whole completions instead of streaming')
+    parser.add_argument('--llm-latency', type=float, default=0.3, help='seconds until the fake model starts answering')
+    parser.add_argument('--token-interval', type=float, default=0.02, help='seconds between streamed words')
+    parser.add_argument('--speech-cps', type=float, default=40.0, help='characters per second the fake speaker.bot plays')
+    parser.add_argument('--openai-port', type=int, default=18080)
+    parser.add_argument('--speaker-port', type=int, default=17585)
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-v', '--verbose', action='store_true', help='show the consumer log')
+    args = parser.parse_args()
+
+    sys.path.insert(0, HERE)
+    os.environ.setdefault('OPENAI_API_KEY', 'benchmark')  # chat.py builds a client at import time
+    import creds
+    creds.OPENAI_API_KEY = creds.OPENAI_API_KEY or 'benchmark'
+    random.seed(args.seed)
+
+    results = []
+    for rate in args.rates:
+        result = run_rate(args, rate)
+        print(report(result), flush=True)
+        results.append(result)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -1,10 +1,15 @@
+import abc
+import asyncio
+
+import httpx
 import openai
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 
-client = OpenAI(api_key=creds.OPENAI_API_KEY)
 import creds
 from logger import Logger
 
+client = OpenAI(api_key=creds.OPENAI_API_KEY)
+
 
 def open_file(filepath):
     with open(filepath, 'r', encoding='utf-8') as infile:
@@ -21,7 +26,7 @@ def gpt3_completion(system_prompt, messages,logger:Logger,verbose = False, engin
     for m in messages:
         msg.append(m)
     logger.info(msg, verbose)
-    response = client.completions.create(model=engine,
+    response = client.chat.completions.create(model=engine,
     messages=msg,
     temperature=temp,
     max_tokens=tokens,
@@ -29,4 +34,167 @@ def gpt3_completion(system_prompt, messages,logger:Logger,verbose = False, engin
     presence_penalty=pres_pen,
     stop=stop)
     text = response.choices[0].message.content.strip()
-    return text
\ No newline at end of file
+    return text
+
+
+class CompletionBackend(abc.ABC):
+    """
+    Turns a list of chat messages into a completion. Subclass this to plug in
+    something other than OpenAI.
+    """
+
+    @abc.abstractmethod
+    async def complete(self, messages: list, **params) -> str:
+        ...
+
+    async def stream(self, messages: list, **params):
+        # backends without streaming support deliver everything as one delta
+        yield await self.complete(messages, **params)
+
+    async def close(self):
+        pass
+
+
+class OpenAIBackend(CompletionBackend):
+    """
+    OpenAI chat completions over one pooled, keep-alive HTTP client.
+
+    Args:
+    - api_key (str): The OpenAI API key.
+    - base_url (str): Point this at a local fake server for testing, None uses OpenAI.
+    - max_connections (int): Size of the HTTP connection pool.
+    """
+
+    def __init__(self, api_key: str = creds.OPENAI_API_KEY, base_url: str = None, max_connections: int = 10) -> None:
+        self.http_client = httpx.AsyncClient(limits=httpx.Limits(max_connections=max_connections,
+                                                                 max_keepalive_connections=max_connections))
+        self.client = AsyncOpenAI(api_key=api_key or 'local', base_url=base_url, http_client=self.http_client)
+
+    async def complete(self, messages: list, engine='gpt-4o', temp=1.1, tokens=400, freq_pen=2.0, pres_pen=2.0, stop=None, timeout=None) -> str:
+        response = await self.client.chat.completions.create(model=engine,
+                                                             messages=messages,
+                                                             temperature=temp,
+                                                             max_tokens=tokens,
+                                                             frequency_penalty=freq_pen,
+                                                             presence_penalty=pres_pen,
+                                                             stop=stop,
+                                                             timeout=timeout)
+        return response.choices[0].message.content.strip()
+
+    async def stream(self, messages: list, engine='gpt-4o', temp=1.1, tokens=400, freq_pen=2.0, pres_pen=2.0, stop=None, timeout=None):
+        stream = await self.client.chat.completions.create(model=engine,
+                                                           messages=messages,
+                                                           temperature=temp,
+                                                           max_tokens=tokens,
+                                                           frequency_penalty=freq_pen,
+                                                           presence_penalty=pres_pen,
+                                                           stop=stop,
+                                                           timeout=timeout,
+                                                           stream=True)
+        async with stream:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+    async def close(self):
+        await self.client.close()
+
+
+async def _next_delta(iterator):
+    try:
+        return await iterator.__anext__()
+    except StopAsyncIteration:
+        return None
+
+
+class CompletionClient:
+    """
+    Async counterpart to gpt3_completion, with a timeout per request and the
+    option to cancel everything that is still in flight, or only what one
+    group (e.g. one consumer sharing the client) requested.
+
+    Args:
+    - logger (Logger): Logger used for status output.
+    - backend (CompletionBackend): Where completions come from, defaults to OpenAI.
+    - timeout (float): Seconds a single completion may take before it is given up.
+    """
+
+    def __init__(self, logger: Logger, backend: CompletionBackend = None, timeout: float = 20.0) -> None:
+        self.l = logger
+        self.backend = backend if backend is not None else OpenAIBackend()
+        self.timeout = timeout
+        self.in_flight = {}  # task -> group
+
+    async def complete(self, system_prompt, messages, verbose = False, engine='gpt-4o', temp=1.1, tokens=400, freq_pen=2.0, pres_pen=2.0, stop=['SALLY:', 'CHATTER:', 'CHATTER_NAME'], timeout: float = None, group: str = None):
+        """
+        Requests a completion for the system prompt followed by messages.
+
+        Returns:
+        - str: The completion, or None if it timed out, failed or was cancelled.
+        """
+        msg = [system_prompt, *messages]
+        self.l.info(lambda: repr(msg), verbose)  # msg is a fresh list, safe to format later
+        timeout = self.timeout if timeout is None else timeout
+        task = asyncio.ensure_future(self.backend.complete(msg, engine=engine, temp=temp, tokens=tokens,
+                                                           freq_pen=freq_pen, pres_pen=pres_pen, stop=stop,
+                                                           timeout=timeout))
+        self.in_flight[task] = group
+        try:
+            return await asyncio.wait_for(task, timeout)
+        except asyncio.TimeoutError:
+            self.l.error(f'Completion timed out after {timeout}s')
+        except asyncio.CancelledError:
+            if asyncio.current_task().cancelling():
+                raise  # we were cancelled from outside, not via cancel_all
+            self.l.warning('Completion cancelled')
+        except openai.OpenAIError as e:
+            self.l.error(f'Completion failed: {e}')
+        finally:
+            self.in_flight.pop(task, None)
+        return None
+
+    async def stream(self, system_prompt, messages, verbose = False, engine='gpt-4o', temp=1.1, tokens=400, freq_pen=2.0, pres_pen=2.0, stop=['SALLY:', 'CHATTER:', 'CHATTER_NAME'], timeout: float = None, group: str = None):
+        """
+        Streams a completion as text deltas. The timeout applies to the wait
+        for each delta, so slow consumers of the stream do not trip it.
+
+        Yields:
+        - str: The next piece of the completion. The stream simply ends early
+          if it timed out, failed or was cancelled.
+        """
+        msg = [system_prompt, *messages]
+        self.l.info(lambda: repr(msg), verbose)  # msg is a fresh list, safe to format later
+        timeout = self.timeout if timeout is None else timeout
+        iterator = self.backend.stream(msg, engine=engine, temp=temp, tokens=tokens,
+                                       freq_pen=freq_pen, pres_pen=pres_pen, stop=stop,
+                                       timeout=timeout)
+        try:
+            while True:
+                task = asyncio.ensure_future(_next_delta(iterator))
+                self.in_flight[task] = group
+                try:
+                    delta = await asyncio.wait_for(task, timeout)
+                finally:
+                    self.in_flight.pop(task, None)
+                if delta is None:
+                    return
+                yield delta
+        except asyncio.TimeoutError:
+            self.l.error(f'Completion stream stalled for {timeout}s, giving up')
+        except asyncio.CancelledError:
+            if asyncio.current_task().cancelling():
+                raise
+            self.l.warning('Completion stream cancelled')
+        except openai.OpenAIError as e:
+            self.l.error(f'Completion stream failed: {e}')
+        finally:
+            await iterator.aclose()
+
+    def cancel_all(self, group: str = None):
+        for task, task_group in list(self.in_flight.items()):
+            if group is None or task_group == group:
+                task.cancel()
+
+    async def close(self):
+        self.cancel_all()
+        await self.backend.close()
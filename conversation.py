@@ -0,0 +1,110 @@
+import re
+from collections import deque
+from itertools import islice
+
+NON_WORD = re.compile(r'[\W_]+')
+
+
+def normalize(text: str) -> int:
+    """
+    Reduces a message to a key that ignores case, punctuation and spacing,
+    so 'Sally, hi!!' and 'sally hi' count as the same message.
+
+    Args:
+    - text (str): The raw message content.
+
+    Returns:
+    - int: The hash of the normalized content.
+    """
+    return hash(NON_WORD.sub(' ', text.lower()).strip())
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Rough token count of a chat message: about four characters per token
+    plus the few tokens every message costs on its own.
+    """
+    return len(text) // 4 + 4
+
+
+class Conversation:
+    """
+    The conversation window sent along with every completion, plus a count of
+    the normalized content of every entry for constant time duplicate checks.
+    Keys expire together with the entries they belong to.
+
+    The oldest entries are evicted once either the number of entries or the
+    estimated number of prompt tokens goes over its limit, the newest entry is
+    always kept.
+
+    Args:
+    - limit (int): The maximum number of entries kept.
+    - token_budget (int): The maximum estimated tokens of all entries, None for no limit.
+    """
+
+    def __init__(self, limit: int, token_budget: int = None) -> None:
+        self.limit = limit
+        self.token_budget = token_budget
+        self.entries = deque()
+        self.meta = deque()  # (dedup key, estimated tokens) per entry
+        self.tokens = 0
+        self.index = {}
+
+    def append(self, entry: dict, text: str = None):
+        """
+        Adds an entry to the window.
+
+        Args:
+        - entry (dict): The chat message, e.g. {'role': 'user', 'content': ...}.
+        - text (str): The text duplicates are detected by, defaults to the entry content.
+        """
+        key = normalize(entry['content'] if text is None else text)
+        tokens = estimate_tokens(entry['content'])
+        self.entries.append(entry)
+        self.meta.append((key, tokens))
+        self.tokens += tokens
+        self.index[key] = self.index.get(key, 0) + 1
+
+    def contains(self, text: str) -> bool:
+        return normalize(text) in self.index
+
+    def over_budget(self) -> bool:
+        if len(self.entries) > self.limit:
+            return True
+        return self.token_budget is not None and self.tokens > self.token_budget and len(self.entries) > 1
+
+    def trim(self):
+        while self.over_budget():
+            self.entries.popleft()
+            key, tokens = self.meta.popleft()
+            self.tokens -= tokens
+            self._forget(key)
+
+    def _forget(self, key: int):
+        count = self.index[key] - 1
+        if count:
+            self.index[key] = count
+        else:
+            del self.index[key]
+
+    def recent(self, count: int) -> str:
+        """
+        Returns:
+        - str: The content of the newest count entries, newest first.
+        """
+        return '\n'.join(entry['content'] for entry in islice(reversed(self.entries), count))
+
+    def clear(self):
+        self.entries.clear()
+        self.meta.clear()
+        self.tokens = 0
+        self.index.clear()
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return repr(list(self.entries))
@@ -0,0 +1,52 @@
+import os
+import re
+
+from json_handler import write_file_atomic
+
+CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'english_words.cache')
+WORD = re.compile(r'[a-z]+')
+
+
+class EnglishFilter:
+    """
+    Tells whether a chat message contains English words.
+
+    The word list is read once, from the cache file if it exists, otherwise
+    from the locally installed nltk words corpus, which is then written to
+    the cache so later starts do not need nltk at all. Nothing is
+    downloaded. Messages are split into lowercase words and every word is
+    looked up in a set, so a check costs O(len(message)).
+
+    Args:
+    - cache_path (str): Where the lowercased word list is cached, one word per line.
+    - min_length (int): Shorter words are ignored, the corpus contains every single letter.
+    """
+
+    def __init__(self, cache_path: str = CACHE_PATH, min_length: int = 2) -> None:
+        self.cache_path = cache_path
+        self.min_length = min_length
+        self.words = self.load()
+
+    def load(self) -> frozenset:
+        if os.path.exists(self.cache_path):
+            with open(self.cache_path, 'r', encoding='utf-8') as file:
+                return frozenset(file.read().split('\n')) - {''}
+        try:
+            from nltk.corpus import words  # only needed until the cache exists
+            words = frozenset(word.lower() for word in words.words())
+        except (ImportError, LookupError):
+            print("No English word list found, run nltk.download('words') once. Letting every message through.")
+            return frozenset()
+        self.save(words)
+        return words
+
+    def save(self, words: frozenset):
+        try:
+            write_file_atomic(self.cache_path, '\n'.join(sorted(words)))
+        except OSError as e:
+            print(f"Unable to cache the word list in '{self.cache_path}': {e}")
+
+    def is_english(self, text: str) -> bool:
+        if not self.words:
+            return True  # no word list, nothing to filter with
+        return any(len(word) >= self.min_length and word in self.words for word in WORD.findall(text.lower()))
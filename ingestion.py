@@ -0,0 +1,326 @@
+import asyncio
+import os
+import zlib
+
+from json_handler import write_file_atomic
+from logger import Logger
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:  # not available on Windows / not installed, fall back to polling
+    INotify = None
+    flags = None
+
+
+class ExchangeWatcher:
+    """
+    Wakes up only when one of the watched exchange files changes.
+
+    Uses inotify on the parent directories when inotify_simple is installed,
+    otherwise polls os.stat() with an adaptive backoff that resets as soon as
+    something changes.
+
+    Args:
+    - paths (list): The exchange files to watch.
+    - logger (Logger): Logger used for status output.
+    - min_interval (float): Poll interval right after a change, in seconds.
+    - max_interval (float): Upper bound the poll interval backs off to, in seconds.
+    - use_inotify (bool): Set to False to force the polling fallback.
+    """
+
+    def __init__(self, paths, logger: Logger, min_interval: float = 0.05, max_interval: float = 1.0, use_inotify: bool = True) -> None:
+        self.l = logger
+        self.paths = [os.path.abspath(p) for p in paths]
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.stats = {path: self._stat(path) for path in self.paths}
+        self.inotify = None
+        self.changed = set()
+        self.event = None
+        if use_inotify and INotify is not None:
+            self._setup_inotify()
+        else:
+            self.l.info('inotify not available, polling exchange files')
+
+    def _setup_inotify(self):
+        try:
+            self.inotify = INotify(nonblocking=True)
+            mask = flags.MODIFY | flags.CLOSE_WRITE | flags.CREATE | flags.MOVED_TO
+            self.watches = {}
+            for path in self.paths:
+                directory = os.path.dirname(path)
+                if directory not in self.watches.values():
+                    self.watches[self.inotify.add_watch(directory, mask)] = directory
+            self.l.passing('Watching exchange files with inotify')
+        except OSError as e:
+            self.l.warning(f'Unable to set up inotify, polling instead: {e}')
+            self.inotify = None
+
+    @staticmethod
+    def _stat(path):
+        try:
+            st = os.stat(path)
+            return st.st_mtime_ns, st.st_size, st.st_ino
+        except FileNotFoundError:
+            return None
+
+    def _on_readable(self):
+        for event in self.inotify.read(timeout=0):
+            path = os.path.join(self.watches.get(event.wd, ''), event.name)
+            if path in self.paths:
+                self.changed.add(path)
+        if self.changed:
+            self.event.set()
+
+    async def wait(self, timeout: float = None) -> set:
+        """
+        Waits until at least one watched file changed.
+
+        Args:
+        - timeout (float): Give up after this many seconds, None waits forever.
+
+        Returns:
+        - set: The absolute paths of the files that changed, empty on timeout.
+        """
+        try:
+            if self.inotify is not None:
+                return await asyncio.wait_for(self._wait_inotify(), timeout)
+            return await asyncio.wait_for(self._wait_polling(), timeout)
+        except asyncio.TimeoutError:
+            return set()
+
+    async def _wait_inotify(self) -> set:
+        if self.event is None:
+            self.event = asyncio.Event()
+            asyncio.get_running_loop().add_reader(self.inotify.fileno(), self._on_readable)
+        await self.event.wait()
+        self.event.clear()
+        changed, self.changed = self.changed, set()
+        return changed
+
+    async def _wait_polling(self) -> set:
+        while True:
+            changed = set()
+            for path in self.paths:
+                stat = self._stat(path)
+                if stat != self.stats[path]:
+                    self.stats[path] = stat
+                    changed.add(path)
+            if changed:
+                self.interval = self.min_interval
+                return changed
+            await asyncio.sleep(self.interval)
+            self.interval = min(self.interval * 2, self.max_interval)
+
+    def close(self):
+        if self.inotify is not None:
+            if self.event is not None:
+                try:
+                    asyncio.get_running_loop().remove_reader(self.inotify.fileno())
+                except RuntimeError:
+                    pass
+            self.inotify.close()
+            self.inotify = None
+
+
+class ExchangeTail:
+    """
+    Reads only the bytes appended to an exchange file since the last read.
+
+    Instead of truncating the file (which loses lines written between the
+    read and the truncate), the file is atomically renamed away once it grows
+    past rotate_size, the rest of the renamed file is drained and it is then
+    removed. The writer simply creates a fresh file on its next append.
+
+    Nothing read from disk is dropped: an unfinished last line of a rotated
+    file is carried over and completed by the next file, and on close() the
+    read position (plus anything not yet handed out) is kept next to the
+    file, so the next start continues where this one stopped.
+
+    Args:
+    - path (str): The exchange file to tail.
+    - logger (Logger): Logger used for status output.
+    - rotate_size (int): Size in bytes after which the file gets rotated.
+    """
+
+    def __init__(self, path: str, logger: Logger, rotate_size: int = 16 * 1024) -> None:
+        self.l = logger
+        self.path = path
+        self.rotated_path = path + '.consumed'
+        self.position_path = path + '.position'
+        self.rotate_size = rotate_size
+        self.offset = 0
+        self.inode = None
+        self.partial_size = None
+        self.carry = b''  # unfinished last line of a rotated file, completed by the next one
+        self.modified = None  # mtime of the file when lines were last read from it
+        self.rotate_on_next_read = True  # content from before startup is consumed once, then rotated away
+        self._restore_position()
+        self.pending = self._drain_rotated()  # left over by a crash or by close(), handed out first
+
+    def _read_from(self, path: str, offset: int):
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            return b'', None
+        try:
+            st = os.fstat(fd)
+            if st.st_size <= offset:
+                return b'', st
+            if hasattr(os, 'pread'):
+                data = os.pread(fd, st.st_size - offset, offset)
+            else:
+                os.lseek(fd, offset, os.SEEK_SET)
+                data = os.read(fd, st.st_size - offset)
+            return data, st
+        finally:
+            os.close(fd)
+
+    def read_lines(self) -> list:
+        """
+        Returns the complete lines appended since the last call.
+
+        A trailing line without a newline is left in the file until the writer
+        finishes it, or until a later read finds the file unchanged, in which
+        case it is taken as the last line.
+
+        Returns:
+        - list: The new lines, without line endings.
+        """
+        lines, self.pending = self.pending, []
+        data, st = self._read_from(self.path, self.offset)
+        if st is None:
+            self.offset = 0
+            self.inode = None
+            self.rotate_on_next_read = False  # nothing from before startup, a new file only rotates once it grew
+        elif self.inode is not None and st.st_ino != self.inode or st.st_size < self.offset:
+            # file was replaced or truncated by someone else, start over
+            self.offset = 0
+            data, st = self._read_from(self.path, 0)
+        if st is None and not self.carry:
+            return lines
+        size = -1 if st is None else st.st_size
+        if st is not None:
+            self.inode = st.st_ino
+
+        state = (size, self.offset + len(data))  # file size and how far it was read, unchanged means the writer is done
+        data = self.carry + data
+        end = data.rfind(b'\n') + 1
+        if end < len(data):
+            if self.partial_size == state:
+                end = len(data)
+                self.partial_size = None
+            else:
+                self.partial_size = state
+        else:
+            self.partial_size = None
+        new = self._split(data[:end])
+        # the carried bytes come first, only what was used beyond them was read from this file
+        self.offset += max(end - len(self.carry), 0)
+        self.carry = self.carry[end:]
+        if new and st is not None:
+            self.modified = st.st_mtime
+        lines += new
+
+        if st is not None and (self.rotate_on_next_read or self.offset >= self.rotate_size):
+            lines += self._rotate()
+        return lines
+
+    @property
+    def has_partial(self) -> bool:
+        return self.partial_size is not None
+
+    @staticmethod
+    def _split(data: bytes) -> list:
+        return [line for line in data.decode('utf-8', errors='replace').splitlines() if line]
+
+    def _rotate(self) -> list:
+        try:
+            os.replace(self.path, self.rotated_path)
+        except FileNotFoundError:
+            return []
+        except OSError as e:
+            # on Windows the file can not be renamed while streamer.bot holds it open, retry next time
+            self.l.warning(f"Unable to rotate '{self.path}': {e}")
+            return []
+        self.rotate_on_next_read = False
+        offset, self.offset, self.inode, self.partial_size = self.offset, 0, None, None
+        return self._drain_rotated(offset)
+
+    def _drain_rotated(self, offset: int = 0) -> list:
+        # anything appended between our last read and the rename ends up here, a writer
+        # still holding the old file may keep appending, so read until its size settles
+        data = b''
+        while True:
+            chunk, st = self._read_from(self.rotated_path, offset)
+            if st is None:
+                break
+            data += chunk
+            offset += len(chunk)
+            try:
+                if os.stat(self.rotated_path).st_size <= offset:
+                    break
+            except FileNotFoundError:
+                break
+        if st is None and not data:
+            return []
+        data = self.carry + data
+        end = data.rfind(b'\n') + 1
+        self.carry = data[end:]
+        if self.carry:
+            self.partial_size = None  # the next read decides whether it gets finished
+        try:
+            os.remove(self.rotated_path)
+        except OSError as e:
+            self.l.warning(f"Unable to remove '{self.rotated_path}': {e}")
+        return self._split(data[:end])
+
+    def _restore_position(self):
+        try:
+            with open(self.position_path, 'r', encoding='utf-8') as file:
+                inode, offset, checksum = (int(field) for field in file.read().split())
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            self.l.warning(f"Ignoring unreadable '{self.position_path}': {e}")
+            inode = None
+        try:
+            os.remove(self.position_path)
+        except OSError as e:
+            self.l.warning(f"Unable to remove '{self.position_path}': {e}")
+        if inode is None:
+            return
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return
+        # inode numbers are reused, so the part already read must also still be the same
+        if st.st_ino == inode and st.st_size >= offset and self._checksum(offset) == checksum:
+            self.inode = inode
+            self.offset = offset
+
+    def _checksum(self, length: int) -> int:
+        try:
+            with open(self.path, 'rb') as file:
+                return zlib.crc32(file.read(length))
+        except OSError:
+            return None
+
+    def close(self):
+        """
+        Leaves the unread part of the file where it is and remembers how far
+        it was read. Lines read from disk but not handed out yet are put back
+        into the rotated file, which the next start drains first.
+        """
+        try:
+            if self.pending or self.carry:
+                kept = ''.join(line + '\n' for line in self.pending).encode('utf-8') + self.carry
+                write_file_atomic(self.rotated_path, kept)
+                self.pending, self.carry = [], b''
+            if self.inode is not None and self.offset:
+                checksum = self._checksum(self.offset)
+                if checksum is not None:
+                    write_file_atomic(self.position_path, f'{self.inode} {self.offset} {checksum}'.encode('utf-8'))
+        except OSError as e:
+            self.l.warning(f"Unable to keep the read position of '{self.path}': {e}")
@@ -1,3 +1,4 @@
+import asyncio
 import json
 import os
 
@@ -42,4 +43,108 @@ def write_to_json_file(data, file_path):
         return True
     except Exception as e:
         print(f"Error occurred while writing to file '{file_path}': {e}")
-        return False
\ No newline at end of file
+        return False
+
+def write_file_atomic(file_path: str, data):
+    """
+    Write a file without ever leaving a half written one behind: the data goes
+    to a temporary file first, which is synced and then replaces the target.
+
+    Args:
+    - file_path (str): The path of the file to write.
+    - data (str or bytes): The new content, str is written as UTF-8.
+
+    Raises:
+    - OSError: If the file could not be written, the target is then unchanged.
+    """
+    tmp_path = f'{file_path}.tmp'
+    mode, encoding = ('wb', None) if isinstance(data, bytes) else ('w', 'utf-8')
+    with open(tmp_path, mode, encoding=encoding) as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, file_path)
+
+
+def write_json_file_atomic(data, file_path):
+    """
+    Write data to a JSON file without ever leaving a half written file behind,
+    see write_file_atomic.
+
+    Args:
+    - data (dict): The data to be written, should be a dictionary.
+    - file_path (str): The path to the JSON file to write.
+
+    Returns:
+    - bool: True if writing is successful, False otherwise.
+    """
+    try:
+        write_file_atomic(file_path, json.dumps(data, indent=4))
+        return True
+    except Exception as e:
+        print(f"Error occurred while writing to file '{file_path}': {e}")
+        return False
+
+
+class Journal:
+    """
+    Append-only change log kept next to a snapshot file (the compacted
+    memory, the token balances, ...), one change per line.
+
+    Before a snapshot is written the log is moved to <path>.old and a fresh
+    one is started, so the changes that arrive while the snapshot is being
+    written are not mixed in with the ones it covers. The old log is removed
+    once the snapshot was saved. If saving failed it is kept, and later
+    changes go to the current log until a snapshot succeeds. Replaying both
+    logs in order on top of the last snapshot restores the state.
+
+    Args:
+    - path (str): The change log.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.old_path = path + '.old'
+        self.file = None
+
+    def replay_paths(self) -> list:
+        return [path for path in (self.old_path, self.path) if os.path.exists(path)]
+
+    def open(self):
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    def write(self, line: str):
+        self.file.write(line + '\n')
+
+    def flush(self):
+        self.file.flush()
+
+    async def snapshot(self, write, *args) -> bool:
+        """
+        Writes a snapshot with write(*args) on a worker thread.
+
+        Args:
+        - write: Blocking function saving the snapshot, returning False or
+          raising OSError if it failed.
+
+        Returns:
+        - bool: True if the snapshot was saved and the old log removed.
+
+        Raises:
+        - OSError: Whatever write raised, the old log is kept.
+        """
+        if not os.path.exists(self.old_path):
+            self.file.close()
+            os.replace(self.path, self.old_path)
+            self.open()
+        else:
+            self.file.flush()
+        if await asyncio.to_thread(write, *args) is False:
+            return False
+        os.remove(self.old_path)
+        return True
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
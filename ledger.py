@@ -0,0 +1,279 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from json_handler import Journal, read_json_file, write_json_file_atomic
+from logger import Logger
+
+DEFAULT_PLATFORM = 'YouTube'
+
+
+class TokenLedger:
+    """
+    Sally token balances per viewer, kept in memory.
+
+    Every grant and redemption is appended to a journal. Snapshots of all
+    balances are written in the background, either every snapshot_interval
+    seconds or after snapshot_every changes, and replace the previous one
+    atomically. On startup the last snapshot is loaded and the journal
+    replayed on top of it.
+
+    Args:
+    - logger (Logger): Logger used for status output.
+    - snapshot_path (str): The JSON snapshot of all balances.
+    - journal_path (str): The append-only journal of changes since the snapshot.
+    - snapshot_every (int): Changes after which a snapshot is taken early.
+    - snapshot_interval (float): Seconds between snapshots while there are changes.
+    """
+
+    def __init__(self, logger: Logger, snapshot_path: str = 'sally_tokens.json', journal_path: str = 'sally_tokens.journal',
+                 snapshot_every: int = 500, snapshot_interval: float = 60.0) -> None:
+        self.l = logger
+        self.snapshot_path = snapshot_path
+        self.journal = Journal(journal_path)
+        self.snapshot_every = snapshot_every
+        self.snapshot_interval = snapshot_interval
+        self.balances = {}
+        self.seq = 0
+        self.changes = 0
+        self.load()
+        self.journal.open()
+        self.snapshot_due = asyncio.Event()
+        self.closing = False
+        self.task = None
+
+    def load(self):
+        data = read_json_file(self.snapshot_path) if os.path.exists(self.snapshot_path) else {}
+        if isinstance(data.get('balances'), dict):
+            self.balances = data['balances']
+            self.seq = data.get('seq', 0)
+        else:
+            self.balances = data  # plain {user: balance} from before the journal existed
+        snapshot_seq = self.seq
+        replayed = 0
+        for path in self.journal.replay_paths():
+            with open(path, 'r', encoding='utf-8') as journal:
+                for line in journal:
+                    try:
+                        seq, user, delta = json.loads(line)
+                    except ValueError:
+                        continue  # torn last line after a crash
+                    if seq <= snapshot_seq:
+                        continue
+                    self.balances[user] = self.balances.get(user, 0) + delta
+                    self.seq = max(self.seq, seq)
+                    replayed += 1
+        self.changes = replayed
+        self.l.info(f'Loaded {len(self.balances)} token balances, replayed {replayed} journal entries')
+
+    # the JSON ledger predates multiple platforms and keys viewers by name only
+
+    def balance(self, user: str, platform: str = DEFAULT_PLATFORM) -> int:
+        return self.balances.get(user, 0)
+
+    def grant(self, user: str, amount: int = 1, platform: str = DEFAULT_PLATFORM):
+        self._apply(user, amount)
+
+    def redeem(self, user: str, cost: int, platform: str = DEFAULT_PLATFORM) -> bool:
+        """
+        Takes cost tokens from user if they have enough.
+
+        Returns:
+        - bool: True if the tokens were taken, False if the balance was too low.
+        """
+        if self.balance(user) < cost:
+            return False
+        self._apply(user, -cost)
+        return True
+
+    def _apply(self, user: str, delta: int):
+        self.seq += 1
+        self.balances[user] = self.balances.get(user, 0) + delta
+        self.journal.write(json.dumps([self.seq, user, delta]))  # buffered, flushed by the background task
+        self.changes += 1
+        if self.changes >= self.snapshot_every:
+            self.snapshot_due.set()
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        last_snapshot = time.monotonic()
+        while True:
+            try:
+                await asyncio.wait_for(self.snapshot_due.wait(), 1.0)
+            except asyncio.TimeoutError:
+                pass
+            self.journal.flush()
+            if self.changes and (self.snapshot_due.is_set() or self.closing
+                                 or time.monotonic() - last_snapshot >= self.snapshot_interval):
+                await self.snapshot()
+                last_snapshot = time.monotonic()
+            if self.closing:
+                return
+
+    async def snapshot(self):
+        self.snapshot_due.clear()
+        data = {'seq': self.seq, 'balances': dict(self.balances)}
+        self.changes = 0
+        if await self.journal.snapshot(write_json_file_atomic, data, self.snapshot_path):
+            self.l.info(f'Saved {len(data["balances"])} token balances')
+        else:
+            self.l.error('Unable to save token balances, keeping the journal')
+
+    async def close(self):
+        # let the background task finish its last snapshot instead of cancelling it halfway
+        self.closing = True
+        if self.task is not None:
+            self.snapshot_due.set()
+            await self.task
+            self.task = None
+        elif self.changes:
+            await self.snapshot()
+        self.journal.close()
+
+
+class SqliteLedger:
+    """
+    Sally token balances in an embedded SQLite database, for channels where
+    the all time viewer count makes keeping every balance in memory and
+    parsing sally_tokens.json on startup too expensive.
+
+    Balances are looked up by (author, platform) through the primary key.
+    Grants and redemptions are collected in memory and written in one
+    transaction by a background task, on a separate connection in a worker
+    thread. The database runs in WAL mode so those writes never block lookups.
+
+    Args:
+    - logger (Logger): Logger used for status output.
+    - db_path (str): The SQLite database file.
+    - import_path (str): JSON ledger imported once if the database is empty.
+    - flush_every (int): Pending changes after which they are written early.
+    - flush_interval (float): Seconds between writes while there are changes.
+    """
+
+    def __init__(self, logger: Logger, db_path: str = 'sally_tokens.db', import_path: str = 'sally_tokens.json',
+                 flush_every: int = 500, flush_interval: float = 1.0) -> None:
+        self.l = logger
+        self.db_path = db_path
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.reader = self._connect()
+        self.writer = self._connect(check_same_thread=False)
+        self.writer.executescript(
+            'CREATE TABLE IF NOT EXISTS viewers ('
+            ' author TEXT NOT NULL,'
+            ' platform TEXT NOT NULL,'
+            ' tokens INTEGER NOT NULL DEFAULT 0,'
+            ' PRIMARY KEY (author, platform)'
+            ') WITHOUT ROWID;'
+        )
+        self.pending = {}  # (author, platform) -> delta not yet written
+        self.flushing = {}  # deltas currently being written by the worker thread
+        self.committed = threading.Lock()  # held while a write commits and while a balance is read
+        self.flush_due = asyncio.Event()
+        self.closing = False
+        self.task = None
+        self._import(import_path)
+
+    def _connect(self, check_same_thread: bool = True) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.db_path, check_same_thread=check_same_thread)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def _import(self, import_path: str):
+        if self.writer.execute('SELECT 1 FROM viewers LIMIT 1').fetchone() is not None:
+            return
+        if import_path is None or not os.path.exists(import_path):
+            return
+        data = read_json_file(import_path)
+        balances = data['balances'] if isinstance(data.get('balances'), dict) else data
+        with self.writer:
+            self.writer.executemany('INSERT INTO viewers (author, platform, tokens) VALUES (?, ?, ?)',
+                                    ((user, DEFAULT_PLATFORM, tokens) for user, tokens in balances.items()))
+        self.l.passing(f'Imported {len(balances)} token balances from {import_path}')
+
+    def balance(self, user: str, platform: str = DEFAULT_PLATFORM) -> int:
+        key = (user, platform)
+        with self.committed:
+            row = self.reader.execute('SELECT tokens FROM viewers WHERE author = ? AND platform = ?', key).fetchone()
+            stored = (row[0] if row is not None else 0) + self.flushing.get(key, 0)
+        return stored + self.pending.get(key, 0)
+
+    def grant(self, user: str, amount: int = 1, platform: str = DEFAULT_PLATFORM):
+        self._apply((user, platform), amount)
+
+    def redeem(self, user: str, cost: int, platform: str = DEFAULT_PLATFORM) -> bool:
+        """
+        Takes cost tokens from user if they have enough.
+
+        Returns:
+        - bool: True if the tokens were taken, False if the balance was too low.
+        """
+        if self.balance(user, platform) < cost:
+            return False
+        self._apply((user, platform), -cost)
+        return True
+
+    def _apply(self, key: tuple, delta: int):
+        self.pending[key] = self.pending.get(key, 0) + delta
+        if len(self.pending) >= self.flush_every:
+            self.flush_due.set()
+
+    def _write(self, changes: dict):
+        # runs on a worker thread. The changes are forgotten in the same step they are committed,
+        # so balance() sees them either in flushing or in the database, never in both
+        try:
+            self.writer.executemany('INSERT INTO viewers (author, platform, tokens) VALUES (?, ?, ?) '
+                                    'ON CONFLICT (author, platform) DO UPDATE SET tokens = tokens + excluded.tokens',
+                                    ((author, platform, delta) for (author, platform), delta in changes.items()))
+            with self.committed:
+                self.writer.commit()
+                self.flushing = {}
+        except BaseException:
+            self.writer.rollback()
+            raise
+
+    async def flush(self):
+        self.flush_due.clear()
+        if not self.pending:
+            return
+        self.flushing, self.pending = self.pending, {}
+        try:
+            await asyncio.to_thread(self._write, self.flushing)
+        except sqlite3.Error as e:
+            self.l.error(f'Unable to save token balances, retrying: {e}')
+            for key, delta in self.flushing.items():
+                self.pending[key] = self.pending.get(key, 0) + delta
+            self.flushing = {}
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.flush_due.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+            if self.closing:
+                return
+
+    async def close(self):
+        # let the background task finish its last write instead of cancelling it halfway
+        self.closing = True
+        if self.task is not None:
+            self.flush_due.set()
+            await self.task
+            self.task = None
+        else:
+            await self.flush()
+        self.reader.close()
+        self.writer.close()
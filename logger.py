@@ -1,69 +1,335 @@
+import atexit
+import gzip
+import json
 import logging
+import queue
+import re
+import shutil
+import sys
 import time
 import os
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener
+
+
+class LazyMessage():
+    # only calls factory when a handler actually formats the record
+    __slots__ = ('factory',)
+
+    def __init__(self, factory):
+        self.factory = factory
+
+    def __str__(self):
+        return str(self.factory())
+
+
+def lazy(skk):
+    return LazyMessage(skk) if callable(skk) else skk
+
+
+def resolve(skk):
+    return skk() if callable(skk) else skk
+
+
+class BatchedStreamHandler(logging.StreamHandler):
+    """
+    StreamHandler that leaves flushing to the BufferedQueueListener, so a
+    burst of records ends up in one write.
+    """
+
+    def emit(self, record):
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
+
+class BatchedFileHandler(logging.FileHandler):
+    def emit(self, record):
+        if self.stream is None:
+            self.stream = self._open()
+        BatchedStreamHandler.emit(self, record)
+
+
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'time': record.created, 'level': record.levelname, 'logger': record.name,
+                 'message': record.getMessage()}
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text  # exc_info was already dropped, e.g. by a stock QueueHandler
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class RotatingLogHandler(BatchedFileHandler):
+    """
+    File handler that starts a new log file once the current one reached
+    max_bytes or is older than interval seconds. Rotated files are renamed to
+    <name>.<timestamp>-<sequence><ext>, which sorts oldest first, and gzipped on a background thread, only the
+    newest backup_count archives are kept. A log left over from an earlier
+    run is archived the same way on startup instead of being deleted.
+
+    Args:
+    - filename (str): The log file.
+    - max_bytes (int): Size after which the file is rotated, 0 for no limit.
+    - interval (float): Seconds after which the file is rotated, None for no limit.
+    - backup_count (int): Archives kept, 0 to keep all of them.
+    - compress (bool): Whether archives are gzipped.
+    - flush_each (bool): Flush after every record, False when a BufferedQueueListener flushes.
+    """
+
+    def __init__(self, filename, max_bytes = 0, interval = None, backup_count = 0, compress = True, flush_each = True, encoding = 'utf-8'):
+        super().__init__(filename, mode='a', encoding=encoding, delay=True)
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.backup_count = backup_count
+        self.compress = compress
+        self.flush_each = flush_each
+        self.archiver = ThreadPoolExecutor(max_workers=1, thread_name_prefix='log-archiver')
+        root, self.ext = os.path.splitext(self.baseFilename)
+        self.archive_prefix = root + '.'
+        self.archive_pattern = re.compile(re.escape(os.path.basename(root)) + r'\.\d{8}-\d{6}-\d{6}' + re.escape(self.ext) + r'(?:\.gz)?$')
+        self.rollover_at = None
+        self.sequence = 0
+        self.bytes_written = 0  # into the current file, see emit()
+        if os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename) > 0:
+            self.doRollover()
+        self.reset_timer()
+
+    def reset_timer(self):
+        self.rollover_at = time.time() + self.interval if self.interval else None
+
+    def shouldRollover(self, record):
+        if self.rollover_at is not None and time.time() >= self.rollover_at:
+            return True
+        return bool(self.max_bytes) and self.bytes_written >= self.max_bytes
+
+    def emit(self, record):
+        # counts what it writes instead of asking the stream, tell() would flush it on every record
+        if self.shouldRollover(record):
+            self.doRollover()
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            text = self.format(record) + self.terminator
+            self.stream.write(text)
+            self.bytes_written += len(text.encode(self.encoding or 'utf-8', errors='replace'))
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+        if self.flush_each:
+            self.flush()
+
+    def archive_name(self):
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        while True:
+            self.sequence += 1
+            name = f'{self.archive_prefix}{stamp}-{self.sequence:06d}{self.ext}'
+            if not any(os.path.exists(name + suffix) for suffix in ('', '.gz', '.gz.tmp')):
+                return name
+
+    def doRollover(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        if os.path.exists(self.baseFilename):
+            archive = self.archive_name()
+            os.replace(self.baseFilename, archive)
+            self.archiver.submit(self.archive, archive)
+        self.bytes_written = 0
+        self.reset_timer()
+
+    def archive(self, path):
+        # runs on the archiver thread, so compressing never holds up logging
+        if self.compress:
+            try:
+                with open(path, 'rb') as source, gzip.open(path + '.gz.tmp', 'wb') as target:
+                    shutil.copyfileobj(source, target)
+                os.replace(path + '.gz.tmp', path + '.gz')
+                os.remove(path)
+            except OSError as e:
+                print(f'Unable to compress {path}: {e}', file=sys.stderr)
+        if self.backup_count:
+            self.prune()
+
+    def prune(self):
+        # with compression only finished archives count, plain ones may still be waiting for the archiver
+        directory = os.path.dirname(self.baseFilename)
+        suffix = '.gz' if self.compress else self.ext
+        archives = sorted(name for name in os.listdir(directory) if self.archive_pattern.match(name) and name.endswith(suffix))
+        for name in archives[:-self.backup_count]:
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+    def close(self):
+        super().close()
+        self.archiver.shutdown(wait=True)
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    QueueHandler that hands records over as they are. The stock one formats
+    every record on the thread that logs it, here the listener's handlers
+    format them, lazy messages included, and exc_info stays on the record.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class BufferedQueueListener(QueueListener):
+    """
+    QueueListener that flushes its handlers whenever the queue ran empty or
+    batch_size records were handled since the last flush.
+    """
+
+    def __init__(self, queue, *handlers, batch_size = 256):
+        super().__init__(queue, *handlers, respect_handler_level=True)
+        self.batch_size = batch_size
+        self.unflushed = 0
+
+    def dequeue(self, block):
+        if self.unflushed and (self.unflushed >= self.batch_size or self.queue.empty()):
+            self.flush()
+        self.unflushed += 1
+        return self.queue.get(block)
+
+    def flush(self):
+        for handler in self.handlers:
+            handler.flush()
+        self.unflushed = 0
 
 
 class Logger():
-    def __init__(self, console_log = False, file_logging = False, file_URI = None, level = logging.DEBUG, override = False, log_name = "baselog"):
+    """
+    Colored console output plus an optional log file.
+
+    Every message may also be a callable returning the message, it is only
+    called if the message is actually printed or written, so expensive
+    reprs cost nothing while they are switched off.
+
+    With buffered=True printing and writing happen on a background thread:
+    records go unformatted through a DeferredQueueHandler to a
+    BufferedQueueListener, so logging never blocks the caller on I/O or
+    formatting. A callable message is then called on the listener thread, it
+    must not read state the caller keeps changing, pass a snapshot instead. Call close() (also done at exit) to
+    write out what is still queued.
+
+    The log file is rotated by size and optionally by age, see
+    RotatingLogHandler. A log file left over from an earlier run is archived,
+    override is only kept for compatibility. With json_lines=True the file
+    gets one JSON object per record instead of plain text.
+    """
+    def __init__(self, console_log = False, file_logging = False, file_URI = None, level = logging.DEBUG, override = False, log_name = "baselog", buffered = False, batch_size = 256,
+                 max_bytes = 10 * 1024 * 1024, rotate_interval = None, backup_count = 20, compress = True, json_lines = False):
         self.log_name = log_name
         self.console_log = console_log
         self.file_logging = file_logging
+        self.buffered = buffered
+        self.listener = None
+        self.console = None
+        self.file_handler = None
         if file_logging:
             if file_URI is None:
                 file_URI = "{}".format(self.log_name)+"_log_{}".format(time.asctime(time.localtime()))+".txt"
-                
-                    
-            else:
-                if os.path.exists(file_URI) and not override:
-                    raise NameError("Log File already exists! Try setting override flag")
-                else:
-                    if os.path.exists(file_URI) and override:
-                        os.remove(file_URI)
             file_URI = file_URI.replace(" ", "_").replace(":", "-")
             self.file_URI = file_URI
-            logging.basicConfig(filename=file_URI, encoding='utf-8', level=level, format='%(asctime)s %(message)s')
-            
+            self.file_handler = RotatingLogHandler(file_URI, max_bytes=max_bytes, interval=rotate_interval, backup_count=backup_count,
+                                                   compress=compress, flush_each=not buffered)
+            self.file_handler.setFormatter(JsonLinesFormatter() if json_lines else logging.Formatter('%(asctime)s %(message)s'))
+            if not buffered:
+                logging.basicConfig(level=level, handlers=[self.file_handler])
+                atexit.register(self.close)
+        if buffered:
+            self.start_listener(level, batch_size)
+
+    def start_listener(self, level, batch_size):
+        records = queue.SimpleQueue()
+        queue_handler = DeferredQueueHandler(records)
+        console_name = f'{self.log_name}.console'
+        handlers = []
+        if self.file_logging:
+            self.file_handler.addFilter(lambda record: record.name != console_name)
+            handlers.append(self.file_handler)
+            logging.basicConfig(level=level, handlers=[queue_handler])
+        if self.console_log:
+            console_handler = BatchedStreamHandler(sys.stdout)
+            console_handler.addFilter(lambda record: record.name == console_name)
+            handlers.append(console_handler)
+            self.console = logging.getLogger(console_name)
+            self.console.setLevel(logging.DEBUG)
+            self.console.propagate = False
+            self.console.addHandler(queue_handler)
+        self.listener = BufferedQueueListener(records, *handlers, batch_size=batch_size)
+        self.listener.start()
+        atexit.register(self.close)
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener.flush()
+            for handler in self.listener.handlers:
+                handler.close()
+            self.listener = None
+            self.console = None
+        elif self.file_handler is not None:
+            self.file_handler.close()
+
+    def _print(self, *parts):
+        if self.console is not None:
+            self.console.info(' '.join(parts))
+        else:
+            print(*parts)
+
+    def _log(self, level, skk, **kwargs):
+        logging.log(level, lazy(skk), **kwargs)
 
     def warning(self, skk, printout = True): #yellow
         
         if printout and self.console_log:
-            print("\033[93m {}\033[00m" .format("WARNING:"),"\033[93m {}\033[00m" .format(skk))
+            self._print("\033[93m {}\033[00m".format("WARNING:"), "\033[93m {}\033[00m".format(resolve(skk)))
         if self.file_logging:
-            logging.warning(skk)
+            self._log(logging.WARNING, skk)
        
     def error(self, skk, printout = True): #red
         if printout and self.console_log:   
-            print("\033[91m {}\033[00m" .format("ERROR:"),"\033[91m {}\033[00m" .format(skk))
+            self._print("\033[91m {}\033[00m".format("ERROR:"), "\033[91m {}\033[00m".format(resolve(skk)))
         if self.file_logging:
-            logging.error(skk)
+            self._log(logging.ERROR, skk)
         
     def fail(self, skk, printout = True): #red
         if printout and self.console_log: 
-            print("\033[91m {}\033[00m" .format("FATAL:"),"\033[91m {}\033[00m" .format(skk))
+            self._print("\033[91m {}\033[00m".format("FATAL:"), "\033[91m {}\033[00m".format(resolve(skk)))
         if self.file_logging:
-            logging.exception(skk)
+            self._log(logging.ERROR, skk, exc_info=True)
     def passing(self, skk, printout = True): #green
         if printout and self.console_log: 
-            print("\033[92m {}\033[00m" .format(skk))
+            self._print("\033[92m {}\033[00m".format(resolve(skk)))
         if self.file_logging:
-            logging.info(skk)
+            self._log(logging.INFO, skk)
     def passingblue(self, skk, printout = True): #blue
         if printout and self.console_log: 
-            print("\033[96m {}\033[00m" .format(skk))
+            self._print("\033[96m {}\033[00m".format(resolve(skk)))
         if self.file_logging:
-            logging.info(skk)
+            self._log(logging.INFO, skk)
     def info(self, skk, printout = True): #blue
         if printout and self.console_log: 
-            print("\033[94m {}\033[00m" .format("Info:"),"\033[94m {}\033[00m" .format(skk))
+            self._print("\033[94m {}\033[00m".format("Info:"), "\033[94m {}\033[00m".format(resolve(skk)))
         if self.file_logging:
-            logging.debug(skk)
+            self._log(logging.DEBUG, skk)
     def botReply(self,user, skk):#blue
         if self.console_log: 
-            print("\033[94m {}\033[00m" .format("{}:".format(user)),"\033[94m {}\033[00m" .format(skk))
+            self._print("\033[94m {}\033[00m".format("{}:".format(user)), "\033[94m {}\033[00m".format(resolve(skk)))
             
     def userReply(self,user, platform,skk):#green
         if self.console_log: 
-            print("\033[92m {}:\033[00m" .format("{}".format(user)+" on {}".format(platform)),"\033[92m {}\033[00m" .format(skk))
+            self._print("\033[92m {}:\033[00m".format("{}".format(user)+" on {}".format(platform)), "\033[92m {}\033[00m".format(resolve(skk)))
             
             
             
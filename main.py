@@ -1,78 +1,80 @@
-import re
 from asyncio import Queue
 import asyncio
-from datetime import datetime
+import os
+from collections import deque
 
-import aiofiles
-import threading
-from websockets.asyncio.client import connect
 from twitchio.ext import commands
 from twitchio import ChannelInfo
-from chat import gpt3_completion, open_file
+from chat import CompletionClient, open_file
 import time
 import random
 import creds
-import json
-from json_handler import read_json_file, write_json_file
 from logger import Logger
+from messages import CustomMessage
+from ingestion import ExchangeWatcher, ExchangeTail
+from postprocess import SentenceSplitter, ResponseProcessor
+from conversation import Conversation
+from prompt import PromptBuilder
+from ledger import TokenLedger, SqliteLedger
+from memory import Memory
+from admission import AdmissionController, MENTION, STREAMER, REDEEMER
+from supervisor import Supervisor
+from shards import SharedResources, ConsumerRegistry
+from workers import WorkerPool
 
 
 CONVERSATION_LIMIT = 40
+CONVERSATION_TOKENS = 2000  # estimated prompt tokens the conversation may use per completion
+MEMORY_TOP_K = 10  # memos put into the system prompt
+MEMORY_QUERY_ENTRIES = 6  # newest conversation entries the memos are matched against
 
 IGNORED_USERS = ['']
 BLACKLISTED_USERS = ['']
 
-class Memory:
+CHAT_EXCHANGE = 'chat_exchange.txt'
+STREAMER_EXCHANGE = 'streamer_exchange.txt'
+REDEEM_EXCHANGE = 'sally_enable.txt'
 
-    def __init__(self):
-        self.store = []
+LOG_OPTIONS = dict(console_log=True, file_logging=True, file_URI='logs/logger.txt', override=True, buffered=True)
+# QueueConsumer arguments of every channel and persona, further ones share the completion client and speaker.bot, e.g.
+# dict(name='ava', channel='other_channel', persona='Ava', voice='Ava', prompt_path='prompt_ava.txt', data_dir='shards/ava')
+SHARDS = [dict(verbose=True, answer_rate=20, talk_to_self=False, prompt_path='prompt_chat.txt')]
+WORKER_PROCESSES = 0  # run the consumers in this many worker processes, 0 runs them in the main process
 
-    def to_string(self):
-        string = ''
-        for memo in self.store:
-            string += memo + '\n'
-        return string
+class Answer:
+    message: CustomMessage
+    epoch: int
 
-    def append(self, memo):
-        self.store.append(memo)
+    def __init__(self, message: CustomMessage, epoch: int, persona: str = 'Sally') -> None:
+        self.message = message
+        self.epoch = epoch  # conversation epoch the answer was generated for
+        self.sentences = Queue()  # cleaned sentences ready to be spoken, None marks the end
+        self.started_at = None  # when the completion was requested, until the first sentence is ready
+        self.processing = 0.0  # seconds spent cleaning and splitting the response
+        self.processor = ResponseProcessor(persona)
+        self.spoken = asyncio.Event()
 
-    def remove(self, memo):
-        for i, m in enumerate(self.store):
-            if memo == self.store[i]:
-                del self.store[i]
-
-class CustomMessage:
-    author:str
-    content:str
-    plattform:str
-    answer:bool
-    
-    def __init__(self,author:str,content:str, plattform:str) -> None:
-        self.author = author
-        self.content = content
-        self.plattform = plattform
-        self.answer = False
-
-
-async def write_memory(memory: Memory):
-    async with aiofiles.open('memory.txt', mode='w') as file:
-        await file.write(memory.to_string())
-
-async def clean_conversation(response):
-    response = response.replace('_', ' ')  # replace _ with SPACE to make TTS less jarring
-    if response.startswith('Sally:'):
-        response = response.replace('Sally:', '')  # sometimes Sally: shows up
-    if response.startswith('Sally on Twitch:'):
-        response = response.replace('Sally on Twitch:', '')  # don't even...
-    if response.startswith('Sally on YouTube:'):
-        response = response.replace('Sally on YouTube:', '')
-    if response.startswith('Sally on Stream:'):
-        response = response.replace('Sally on Stream:', '')
-    return response
 
 class QueueConsumer:
+    """
+    Answers one channel as one persona. Conversation, memory, token ledger
+    and exchange files belong to the consumer, the completion client, the
+    speaker.bot connection and the metrics are shared with all other
+    consumers created with the same shared resources, see shards.py.
+    Without shared resources the consumer creates its own from llm,
+    speaker_bot_port, chars_per_second, metrics_port and stats_interval,
+    which are ignored otherwise.
+
+    Args:
+    - name (str): Unique name of the consumer, used as metric label and to cancel its completions.
+    - channel (str): Twitch channel the consumer answers, the one in creds.py if None.
+    - persona (str): Name the persona is addressed with and answers as.
+    - voice (str): speaker.bot voice the answers are spoken with.
+    - data_dir (str): Directory of the exchange files, memory and ledger, the working directory if empty.
+    """
     
-    def __init__(self, logger:Logger, speaker_bot_port:int = 7585, no_command:bool = False, verbose:bool = False, answer_rate:int = 30, talk_to_self = False, prompt_path = 'prompt_chat.txt') -> None:
+    def __init__(self, logger:Logger, speaker_bot_port:int = 7585, no_command:bool = False, verbose:bool = False, answer_rate:int = 30, talk_to_self = False, prompt_path = 'prompt_chat.txt', llm: CompletionClient = None, stream_responses: bool = True, chars_per_second: float = 10.0, prefetch_depth: int = 1, ledger_backend: str = 'json', metrics_port: int = None, stats_interval: float = None, target_latency: float = 10.0,
+                 shared: SharedResources = None, name: str = 'sally', channel: str = None, persona: str = 'Sally', voice: str = 'Sally', data_dir: str = '') -> None:
         
         self.last_answer = None
         self.redeemed_at = None
@@ -81,27 +83,56 @@ class QueueConsumer:
         self.sally_costs = 20
 
         self.l = logger
-        self.l.passing('Spawning Consumer')
+        self.l.passing(f'Spawning Consumer {name}')
+        self.name = name
+        self.channel = channel if channel is not None else creds.TWITCH_CHANNEL
+        self.persona = persona
+        self.voice = voice
+        self.owns_shared = shared is None
+        if shared is None:
+            shared = SharedResources(self.l, llm=llm, speaker_bot_port=speaker_bot_port, verbose=verbose, chars_per_second=chars_per_second,
+                                     metrics_port=metrics_port, stats_interval=stats_interval)
+        self.shared = shared
         self.verbose = verbose
-        self.conversation = list()
+        if data_dir:
+            os.makedirs(data_dir, exist_ok=True)
+        self.conversation = Conversation(CONVERSATION_LIMIT, token_budget=CONVERSATION_TOKENS)
         self.queue = Queue()
+        self.backlog = deque()  # messages set aside to be answered while a completion was in flight
+        self.llm = shared.llm
+        self.stream_responses = stream_responses
+        self.prefetch_depth = prefetch_depth  # answers that may be generated ahead of the one being spoken
+        self.answers = Queue(maxsize=max(prefetch_depth, 1))
+        self.answer_taken = asyncio.Event()
+        self.epoch = 0  # bumped whenever the conversation changes in a way that makes lined up answers stale
         self.prompt_path = prompt_path
         self.no_command = no_command
-        self.sally_tokens = read_json_file('sally_tokens.json')
-        self.port = speaker_bot_port
+        if ledger_backend == 'sqlite':
+            self.ledger = SqliteLedger(self.l, db_path=os.path.join(data_dir, 'sally_tokens.db'), import_path=os.path.join(data_dir, 'sally_tokens.json'))
+        else:
+            self.ledger = TokenLedger(self.l, snapshot_path=os.path.join(data_dir, 'sally_tokens.json'), journal_path=os.path.join(data_dir, 'sally_tokens.journal'))
+        self.speaker = shared.speaker
+        self.pacer = shared.pacer  # estimate used when speaker.bot sends no events
         self.answer_rate = answer_rate
+        self.admission = AdmissionController(answer_rate=answer_rate, target_latency=target_latency, max_batch=CONVERSATION_LIMIT // 4)
         self.enjoy_counter = 0
         self.talk_to_self = talk_to_self
         self.is_redeemed = False
         self.cooldown = 300
-        self.memory = Memory()
-        self.l.info('Loading Memory:')
-        for memo in open_file('memory.txt').split('\n'):
-            if memo == '':
-                continue
-            self.l.info(f'Appending: {memo}')
-            self.memory.append(memo)
+        self.activity = None
+        self.loop = None
+        self.closing = False
+        self.watcher = None
+        self.tails = {name: ExchangeTail(os.path.join(data_dir, name), self.l) for name in (CHAT_EXCHANGE, STREAMER_EXCHANGE, REDEEM_EXCHANGE)}
+        self.memory = Memory(self.l, path=os.path.join(data_dir, 'memory.txt'), log_path=os.path.join(data_dir, 'memory.log'))
+        self.memory.load()
+        self.prompt = PromptBuilder()
+        self.prompt.set_memory(self.memory.to_string())
         self.system_prompt = {}
+        self.metrics = shared.metrics
+        self.metrics.gauge('queue_depth', lambda: self.queue.qsize() + len(self.backlog), consumer=self.name)
+        self.metrics.gauge('answer_probability', self.admission.answer_probability, consumer=self.name)
+        self.metrics.gauge('batch_size', self.admission.batch_size, consumer=self.name)
 
     def run(self):
         self.l.passing('starting consumer')
@@ -112,52 +143,147 @@ class QueueConsumer:
         self.last_answer = time.time()
         self.cooldown = 300
         await self.reload_prompt()
-        self.system_prompt = {'role': 'system',
-                              'content': f'{self.prompt_text} DATE:{datetime.today().strftime('%Y-%m-%d')} MEMORY: {self.memory.to_string()}'}
+        self.system_prompt = self.prompt.build()
+        self.loop = asyncio.get_running_loop()
+        self.activity = asyncio.Event()
+        self.watcher = ExchangeWatcher([tail.path for tail in self.tails.values()], self.l)
+        ingestion = asyncio.create_task(self.ingest())
+        if self.owns_shared:
+            await self.shared.start()
+        self.ledger.start()
+        self.memory.start()
+        speech = asyncio.create_task(self.speak_answers())
         try:
-            while True:
-                await self.youtube_chat() #check for new Youtube chat messages
-                await self.voice_control() #check for new Voice commands
+            while not self.closing:
+                await self.wait_for_activity()
+                if self.closing:
+                    break
 
-                while not self.queue.empty():
-                    message = await self.queue.get()
+                while self.has_pending():
+                    message = self.next_message()
                     await self.append_to_conv(message) #purge messages before checking for redeem
 
                 if not self.is_redeemed: # check if overwrite has happened
                     self.is_redeemed = await self.check_for_redeem()
                 self.msg_counter = 0
                 self.redeemed_at = time.time()
-                while self.is_redeemed:
+                while self.is_redeemed and not self.closing:
                     await self.handle_redeem()
 
         except Exception as e:
             self.l.fail(f'Exception in main loop: {e}')
+        finally:
+            ingestion.cancel()
+            speech.cancel()
+            await self.ledger.close()
+            await self.memory.close()
+            if self.owns_shared:
+                await self.shared.close()
+            self.watcher.close()
+            for tail in self.tails.values():
+                tail.close()
+
+    async def ingest(self):
+        # read whatever is left over from before startup, then only on change
+        try:
+            await self.youtube_chat()
+            await self.voice_control()
+            self.notify()
+            while True:
+                # come back for half written lines even if the writer goes quiet
+                partial = any(tail.has_partial for tail in self.tails.values())
+                changed = await self.watcher.wait(0.5 if partial else None)
+                if not changed and not partial:
+                    continue
+                if not changed or any(path.endswith(CHAT_EXCHANGE) for path in changed):
+                    await self.youtube_chat()
+                if not changed or any(path.endswith(STREAMER_EXCHANGE) for path in changed):
+                    await self.voice_control()
+                self.notify()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.l.fail(f'Exception in ingestion: {e}')
+
+    def on_loop(self) -> bool:
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def notify(self):
+        if self.loop is None:
+            return
+        if self.on_loop():
+            self.activity.set()
+        else:
+            self.loop.call_soon_threadsafe(self.activity.set)  # called from another thread
+
+    async def close(self):
+        """
+        Lets main() finish the message it is working on and clean up.
+        """
+        self.closing = True
+        self.notify()
+        if self.loop is not None and self.on_loop():
+            self.answer_taken.set()
+
+    def has_pending(self) -> bool:
+        return bool(self.backlog) or not self.queue.empty()
+
+    def next_message(self) -> CustomMessage:
+        message = self.backlog.popleft() if self.backlog else self.queue.get_nowait()
+        self.dequeued(message)
+        return message
+
+    def dequeued(self, message: CustomMessage):
+        if message.queued_at is not None:
+            self.metrics.observe('queue_wait', time.perf_counter() - message.queued_at)
+            message.queued_at = None
+
+    async def wait_for_activity(self, timeout: float = None):
+        if not self.has_pending():
+            try:
+                await asyncio.wait_for(self.activity.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        self.activity.clear()
 
     async def handle_redeem(self):
-        if self.queue.qsize() > 5:
-            self.l.warning('Flushing Queue')
-            while self.queue.qsize() > 1:
-                message = await self.queue.get()
-                await self.append_to_conv(message)  # purge messages as too many messages have accumulated
-        if not self.queue.empty():
-            message: CustomMessage = await self.queue.get()
-            if any(message.author == user for user in IGNORED_USERS):
-                self.l.warning(f'Message ignored, user on ignore list: {message.author}')
-                return
-            if not await self.check_completion(message):  # checks for already answered messages
-                await self.request_completion(message)  # requests chatGPT completion
-                await asyncio.sleep(len(message.content) / 10)
+        while self.answers.full():
+            # only pick the next message once its answer can be generated right away, so it is as fresh as possible
+            self.answer_taken.clear()
+            await self.complete_while_draining(self.answer_taken.wait())
+        if self.has_pending():
+            pending = []
+            while self.has_pending():
+                pending.append(self.next_message())
+            message, keep, context, dropped = self.admission.select(pending)
+            if dropped:
+                self.l.warning(f'Busy chat, dropping {len(dropped)} messages')
+                self.metrics.increment('messages', 'dropped', len(dropped))
+            self.backlog.extend(keep)  # still worth answering, picked by priority next time
+            handled = False
+            for context_message in context:
+                handled = await self.handle_message(context_message) or handled  # only added to the conversation
+            if message is not None:
+                handled = await self.handle_message(message) or handled
+            if handled:
                 self.last_answer = time.time()
                 return
         if self.talk_to_self and (time.time() - self.last_answer) > 20:  # if more than 30secs elapsed since last message
             await self.request_completion()  # requests chatGPT completion
             self.last_answer = time.time()
             return
-        await self.youtube_chat()  # check for new Youtube chat messages
-        await self.voice_control()  # check for new Voice commands
 
         c_t = time.time()
-        if (c_t - self.redeemed_at > self.cooldown) and self.queue.empty():
+        timeout = max(self.redeemed_at + self.cooldown - c_t, 0)
+        if self.talk_to_self:
+            timeout = min(timeout, max(self.last_answer + 20 - c_t, 0))
+        await self.wait_for_activity(timeout)  # sleeps until new messages arrive or a timer runs out
+
+        c_t = time.time()
+        if (c_t - self.redeemed_at > self.cooldown) and not self.has_pending():
             self.l.passing('Cooldown reached, waiting for another redeem...')
             self.is_redeemed = False
         elif c_t - self.redeemed_at > self.cooldown:
@@ -167,107 +293,227 @@ class QueueConsumer:
                 self.l.warning('Cooldown reached, processed 10 messages, continuing anyway')
                 self.is_redeemed = False
 
+    async def handle_message(self, message: CustomMessage) -> bool:
+        if any(message.author == user for user in IGNORED_USERS):
+            self.l.warning(f'Message ignored, user on ignore list: {message.author}')
+            self.metrics.increment('messages', 'ignored')
+            return False
+        if await self.check_completion(message):  # checks for already answered messages
+            self.metrics.increment('messages', 'ignored')
+            return False
+        await self.request_completion(message)  # requests chatGPT completion
+        return True
+
+    async def complete_while_draining(self, coro):
+        # keep taking messages off the queue while the completion is in flight, the
+        # admission controller picks what to answer and what to keep from them afterwards
+        completion = asyncio.create_task(coro)
+        getter = None
+        try:
+            while not completion.done():
+                getter = asyncio.create_task(self.queue.get())
+                await asyncio.wait({completion, getter}, return_when=asyncio.FIRST_COMPLETED)
+                if not getter.done():
+                    continue
+                self.backlog.append(getter.result())
+                getter = None
+            return completion.result()
+        finally:
+            completion.cancel()
+            if getter is not None:
+                getter.cancel()
+
+    async def stream_answer(self, answer: Answer):
+        # hand every sentence to the speech task as soon as it is complete instead of waiting for the whole response
+        splitter = SentenceSplitter()
+        parts = []
+        async for delta in self.llm.stream(self.system_prompt, self.conversation, verbose = self.verbose, tokens=250, group = self.name):
+            parts.append(delta)
+            started = time.perf_counter()
+            for sentence in splitter.feed(answer.processor.feed(delta)):
+                self.queue_sentence(answer, sentence)
+            answer.processing += time.perf_counter() - started
+        started = time.perf_counter()
+        for rest in splitter.feed(answer.processor.flush()):
+            self.queue_sentence(answer, rest)
+        self.queue_sentence(answer, splitter.flush())
+        answer.processing += time.perf_counter() - started
+        response = ''.join(parts).strip()
+        return response if response else None
+
+    async def generate(self, answer: Answer):
+        # waits for this consumer's turn when all completion slots are taken by other consumers
+        async with self.shared.completions.turn(self.name):
+            if self.stream_responses:
+                return await self.stream_answer(answer)
+            return await self.llm.complete(self.system_prompt, self.conversation, verbose = self.verbose, tokens=250, group = self.name)
+
+    def queue_sentence(self, answer: Answer, sentence: str):
+        sentence = sentence.strip()
+        if sentence:
+            if answer.started_at is not None:
+                self.metrics.observe('first_sentence', time.perf_counter() - answer.started_at)
+                answer.started_at = None
+            answer.sentences.put_nowait(sentence)
+
+    async def speak_answers(self):
+        # speaks lined up answers one after another, only the first sentence
+        # of each answer waits for the previous one to finish playing
+        while True:
+            answer: Answer = await self.answers.get()
+            self.answer_taken.set()
+            first = True
+            dropped = False
+            speaking_time = 0.0
+            sentence = await answer.sentences.get()  # only claim the voice once there is something to say
+            async with self.shared.speech.turn(self.name):  # consumers sharing speaker.bot take turns answer by answer
+                while sentence is not None:
+                    if answer.epoch != self.epoch:
+                        if not dropped:
+                            self.l.warning('Dropping prefetched answer, the conversation changed')
+                            self.metrics.increment('messages', 'dropped')
+                            dropped = True
+                    else:
+                        await self.speak(sentence, wait_for_previous = first)
+                        if first and answer.message is not None:
+                            # from the line landing in the exchange file to its answer going out to speaker.bot
+                            latency = time.time() - answer.message.received_at
+                            self.metrics.observe('end_to_end', latency)
+                            self.admission.responded(latency)
+                        speaking_time += self.pacer.estimate(sentence)
+                        first = False
+                    sentence = await answer.sentences.get()
+            if speaking_time:
+                self.admission.spoken(speaking_time)
+            answer.spoken.set()
+
+    def invalidate_answers(self):
+        self.epoch += 1
+        if self.loop is None:
+            return
+        if self.on_loop():
+            self.llm.cancel_all(self.name)
+        else:
+            self.loop.call_soon_threadsafe(self.llm.cancel_all, self.name)
+
     async def append_to_conv(self, message:CustomMessage):
         cleaned_name = message.author.replace('_',' ')
         content = message.content.encode(encoding='ASCII',errors='ignore').decode()
         self.conversation.append({ 'role': 'user',
-                                  'content': f'{cleaned_name} on {message.plattform}: {content}' })
+                                  'content': f'{cleaned_name} on {message.plattform}: {content}' },
+                                 text = message.content)  # dedup by what was said, not who said it
+        self.conversation.trim()
             
     async def check_for_redeem(self):
         
-        return await self.file2queue('sally_enable.txt', 'Twitch freed Sally with the message')       
+        return await self.file2queue(REDEEM_EXCHANGE, f'Twitch freed {self.persona} with the message')       
     
     async def voice_control(self):
         
-        await self.file2queue('streamer_exchange.txt', 'Stream')       
+        await self.file2queue(STREAMER_EXCHANGE, 'Stream')       
             
     async def youtube_chat(self):
         
-        await self.file2queue('chat_exchange.txt', 'YouTube')
+        await self.file2queue(CHAT_EXCHANGE, 'YouTube')
         
     async def file2queue(self,file_uri:str, plattform:str):
-        file_contents = open_file(file_uri)
-        if len(file_contents) < 1:
+        tail = self.tails[file_uri]
+        fresh = not tail.rotate_on_next_read  # lines left over from before startup would skew the ingestion latency
+        lines = tail.read_lines()
+        if len(lines) < 1:
             return False
-        lines = file_contents.split('\n')
+        msg = None
         for line in lines:
-            if len(line) <1:
+            author, separator, content = line.partition(';msg:')
+            if not separator:
+                self.l.warning(f"Malformed line in '{file_uri}', skipping: {line}")
                 continue
-            contents = line.split(';msg:')
-            msg = CustomMessage(contents[0], contents[1], plattform)
+            msg = CustomMessage(author, content, plattform)
+            if fresh and tail.modified is not None:
+                msg.received_at = tail.modified
+            self.admission.arrived()
             if plattform == 'YouTube':
                 msg = await self.handle_sally_tokens(msg)
-            if plattform == 'Twitch freed Sally with the message':
+            if file_uri == REDEEM_EXCHANGE:
                 msg.answer = True
+                msg.priority = REDEEMER
             else:
-                msg.answer = await self.response_decision(msg)
+                with self.metrics.timer('response_decision'):
+                    msg.answer = await self.response_decision(msg)
+            if fresh:
+                self.metrics.observe('ingestion', max(time.time() - msg.received_at, 0.0))
+            msg.queued_at = time.perf_counter()
+            self.metrics.increment('messages', 'received')
             await self.queue.put(msg)
-            
-            
-        self.delete_file_contents(file_uri)
-        
-        self.l.userReply(msg.author,msg.plattform , msg.content)  
-        return True
+            self.l.userReply(msg.author, msg.plattform, msg.content)
+        return msg is not None
 
     async def handle_sally_tokens(self, message:CustomMessage) -> CustomMessage:
-        await self.grant_sally_token(message.author)
-        if '!sally' in message.content.lower():
-            if self.sally_tokens[message.author] >= self.sally_costs and not self.is_redeemed:
+        await self.grant_sally_token(message.author, message.plattform)
+        if f'!{self.persona.lower()}' in message.content.lower():
+            if self.is_redeemed:
+                self.l.warning(f'{message.author} redeemed {message.content}, while already redeemed')
+            elif self.ledger.redeem(message.author, self.sally_costs, platform=message.plattform):
                 self.l.passing(f'{message.author} redeemed {message.content}')
-                self.sally_tokens[message.author] -= self.sally_costs
                 self.is_redeemed = True
                 message.answer = True
-            elif self.sally_tokens[message.author] < self.sally_costs and not self.is_redeemed: # Amount of msg to send for one enable sally: 20
+                message.priority = REDEEMER
+            else: # Amount of msg to send for one enable sally: 20
                 self.l.warning(f'{message.author} redeemed {message.content} with insuficcient funds')
-            elif self.is_redeemed:
-                self.l.warning(f'{message.author} redeemed {message.content}, while already redeemed')
-        write_to_json_file(self.sally_tokens, 'sally_tokens.json')
         return message
 
-    def delete_file_contents(self, file_path):
-        try:
-            # Open the file in write mode, which truncates the file
-            with open(file_path, 'w'):
-                pass  # Using pass to do nothing inside the with block
-            self.l.passing("Contents of '{}' have been deleted.".format(file_path))
-        except IOError:
-            self.l.error("Unable to delete contents of '{}'.".format(file_path))
-
-    async def grant_sally_token(self, user):
+    async def grant_sally_token(self, user, plattform: str = 'YouTube'):
         if user in BLACKLISTED_USERS:
             self.l.fail(f'User {user} blacklisted, not granting Token')
+            return
         self.l.info(f'Granting {user} sally token')
-        if user in self.sally_tokens.keys():
-            self.sally_tokens[user] += 1
-        else:
-            self.sally_tokens[user] = 1
+        self.ledger.grant(user, platform=plattform)  # saved in the background
 
     async def put_message(self, message): # Only for twitch Message Objects! Not custom message
         author = message.author.name
         msg = message.content
         
-        new_msg = CustomMessage(author, msg, 'Twitch')
-        new_msg.answer = await self.response_decision(new_msg)
-        await self.queue.put(new_msg)
+        await self.accept(CustomMessage(author, msg, 'Twitch'))
+
+    async def accept(self, new_msg: CustomMessage):
+        self.admission.arrived()
+        with self.metrics.timer('response_decision'):
+            new_msg.answer = await self.response_decision(new_msg)
+        new_msg.queued_at = time.perf_counter()
+        self.metrics.increment('messages', 'received')
+        if self.loop is not None and not self.on_loop():
+            # the bot runs on its own loop, hand the message over to the consumer loop
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, new_msg)
+        else:
+            await self.queue.put(new_msg)
+        self.notify()
         
     async def reload_prompt(self):
         self.l.passingblue('Reloading Prompt')
         self.prompt_text = open_file(self.prompt_path)
+        self.prompt.set_template(self.prompt_text)
+        self.invalidate_answers()
+
+    def set_enabled(self, enabled: bool):
+        # streamer override of the redeem, enabled until disabled again
+        self.cooldown = 999999 if enabled else 300
+        self.is_redeemed = enabled
 
     async def toggle_verbosity(self):
         self.verbose = not self.verbose
+        self.speaker.verbose = self.verbose
         self.l.passingblue(f'Verbosity is now: {self.verbose}')
     
     async def clear_conv(self):
         self.l.passingblue('Clearing Conversations')
-        self.conversation = list()
+        self.conversation.clear()
+        self.invalidate_answers()
         
     async def check_completion(self, message: CustomMessage):
         
-        for c in self.conversation:
-            if c['content'] == message.content:
-                return True
-            
+        if self.conversation.contains(message.content):
+            self.l.warning(f'Message ignored, already in conversation: {message.content}')
+            return True
         return False
                 
     async def request_completion(self,message: CustomMessage = None):
@@ -278,14 +524,16 @@ class QueueConsumer:
             # Check if the message is too long or short
             if len(message.content) > 150:
                 self.l.warning('Message ignored: Too long')
+                self.metrics.increment('messages', 'ignored')
                 return
             if len(message.content) < 6:
                 self.l.warning('Message ignored: Too short')
+                self.metrics.increment('messages', 'ignored')
                 return
             
             self.l.warning('--------------\nMessage being processed')
             self.l.userReply(message.author, message.plattform, message.content)
-            self.l.info(self.conversation, printout = self.verbose)
+            self.l.info(lambda entries=list(self.conversation): repr(entries), printout = self.verbose)  # formatted on the log thread, from a snapshot
             
             await self.append_to_conv(message)
             
@@ -293,137 +541,145 @@ class QueueConsumer:
             if not message.answer:
                 self.l.info('Message appended, not answering', printout = self.verbose)
                 return
-        self.system_prompt = {'role': 'system',
-                              'content': f'{self.prompt_text} DATE:{datetime.today().strftime('%Y-%m-%d')} MEMORY: {self.memory.to_string()}'}
-        response:str = gpt3_completion(self.system_prompt , self.conversation, self.l, verbose = self.verbose, tokens=250)
-        cleaned_response = await self.extract_memory(response)
-        cleaned_response = await clean_conversation(cleaned_response)
-
-
-
-        self.l.botReply("Sally",response)
-
-        await self.speak(cleaned_response)
+        answer = Answer(message, self.epoch, self.persona)
+        await self.complete_while_draining(self.answers.put(answer))  # waits while prefetch_depth answers are lined up already
+        answer.epoch = self.epoch
+        self.prompt.set_memory(self.memory.relevant(self.conversation.recent(MEMORY_QUERY_ENTRIES), MEMORY_TOP_K))
+        self.system_prompt = self.prompt.build()  # cached, only rebuilt when template, date, memory or stream info changed
+        try:
+            answer.started_at = started = time.perf_counter()
+            response:str = await self.complete_while_draining(self.generate(answer))
+            self.metrics.observe('completion', time.perf_counter() - started)
+            self.admission.completed(time.perf_counter() - started)
+            if response is None:
+                self.l.warning('No completion received, waiting for next message...\n--------------')
+                self.metrics.increment('messages', 'dropped')
+                return
+            started = time.perf_counter()
+            if not self.stream_responses:
+                self.queue_sentence(answer, answer.processor.process(response))
+            await self.apply_memory(answer.processor.directives)
+            self.metrics.observe('post_processing', answer.processing + time.perf_counter() - started)
+
+            self.l.botReply(self.persona, response)
+        finally:
+            answer.sentences.put_nowait(None)
+
+        if answer.epoch != self.epoch:
+            self.l.warning('Conversation changed while answering, discarding the answer\n--------------')
+            self.metrics.increment('messages', 'dropped')
+            return
+        self.metrics.increment('messages', 'answered')
 
-        if self.conversation.count({'role': 'assistant', 'content': response}) == 0:
+        if not self.conversation.contains(response):
             self.conversation.append({ 'role': 'assistant', 'content': response })
         
-        if len(self.conversation) > CONVERSATION_LIMIT:
-            self.conversation = self.conversation[1:]
-        
-        time.sleep(len(response)/10)
+        self.conversation.trim()
         
+        if self.prefetch_depth == 0:
+            await self.complete_while_draining(answer.spoken.wait())  # no prefetching, wait until the answer was spoken
         self.l.warning('Cooldown ended, waiting for next message...\n--------------')
 
-    async def extract_memory(self, msg: str) -> str:
+    async def apply_memory(self, directives: list):
         """
-        Extracts the string encapsulated in memory{} from the given message.
+        Carries out the memory directives found in a response.
 
         Args:
-            msg (str): The input string containing the memory encapsulation.
-
-        Returns:
-            str: The extracted string inside memory{}, or an empty string if not found.
+            directives (list): ('write' or 'delete', memo) tuples in the order they appeared.
         """
-        pattern = r"write_memory\{(.*?)\}"  # Regex pattern to match memory{DATA_TO_EXTRACT}
-        match_write = re.search(pattern, msg)
-        if match_write:
-            memory = match_write.group(1)
-            msg = re.sub(pattern, '', msg).strip()
-            self.memory.append(memory)
-            await write_memory(self.memory)
-
-        pattern = r"delete_memory\{(.*?)\}"  # Regex pattern to match memory{DATA_TO_EXTRACT}
-        match_delete = re.search(pattern, msg)
-        if match_delete:
-            memo = match_delete.group(1)
-            msg = re.sub(pattern, '', msg).strip()
-            self.memory.remove(memo)
-
-        if match_delete or match_write:
-            await write_memory(self.memory)
-
-        return msg
+        for action, memo in directives:
+            if action == 'write':
+                self.memory.append(memo)
+            else:
+                self.memory.remove(memo)
 
     async def response_decision(self, msg:CustomMessage) -> bool:
+        if msg.plattform == 'Stream':
+            msg.priority = max(msg.priority, STREAMER)
         if self.no_command:
             self.l.info("No Command flag set")
             return True
         
-        if 'sally' in msg.content.lower():
-            self.l.info("Sally in msg")
-            return True
-        
-        if '?response' in msg.content.lower():
-            self.l.info("Command in msg")
-            return True
-        
-        if random.randint(1,100)<self.answer_rate: #respond to 30% of messages anyway 
-            self.l.info("Random trigger")
-            return True
-        
         if 'caesarlp' in msg.author:
             self.l.info("CaesarLP in msg")
+            msg.priority = max(msg.priority, STREAMER)
             return True
         
         if 'Caesar LP' in msg.author:
             self.l.info("Caesar LP in msg")
+            msg.priority = max(msg.priority, STREAMER)
             return True
         if 'CaesarLP' in msg.author:
             self.l.info("Caesar talked")
+            msg.priority = max(msg.priority, STREAMER)
             return True
+        
+        if self.persona.lower() in msg.content.lower():
+            self.l.info(f"{self.persona} in msg")
+            msg.priority = max(msg.priority, MENTION)
+            return True
+        
+        if '?response' in msg.content.lower():
+            self.l.info("Command in msg")
+            msg.priority = max(msg.priority, MENTION)
+            return True
+        
+        if random.random() < self.admission.answer_probability(): # answer_rate percent of messages while chat is calm, less when answers fall behind
+            self.l.info("Random trigger")
+            return True
+        
         self.l.warning('Ignoring message for now')
         return False
 
     def set_stream_info(self, game, title):
         self.l.passing(f'Setting stream info to "{title}" playing "{game}"')
-        self.system_prompt['content'] = self.system_prompt['content'].replace(
-            'STREAM_TITLE', title
-            ).replace('GAME_NAME', game)
+        self.prompt.set_stream_info(game, title)  # kept across prompt reloads
+        self.invalidate_answers()
         
-    async def speak(self, message):
+    async def speak(self, message, wait_for_previous: bool = False):
         
+        if wait_for_previous:
+            await self.pacer.wait_idle()  # the queue keeps being drained meanwhile
         _id = random.randrange(10000,99999)
         if 'enjoy' in message:
             self.enjoy_counter += 1
         data = {
             "request": "Speak",
             "id": f"{_id}",
-            "voice": "Sally",
+            "voice": self.voice,
             "message": f"{message}"
             }
         
         self.l.info(f"Sending Packet with ID {_id}")
         self.l.warning(f'Enjoy counter is {self.enjoy_counter}')
         
-        await self.send_json_via_websocket(data)
+        self.pacer.started(message)
+        ack = await self.send_json_via_websocket(data)
+        ack.add_done_callback(self.observe_ack)
+        return ack
 
-    async def send_json_via_websocket(self, json_data):
-        websocket = await connect(f'ws://localhost:{self.port}/speak')
-        try:
-            # Convert JSON data to string
-            json_string = json.dumps(json_data)
-
-            # Send JSON string via WebSocket
-            await websocket.send(json_string)
-            self.l.info("Sent JSON data")
-            if self.verbose:
-                self.l.info(json_string)
-        except Exception as e:
-            self.l.fail(f'Failed to send JSON data: {e}')
+    def observe_ack(self, ack: asyncio.Future):
+        if not ack.cancelled() and ack.result() is not None:
+            self.metrics.observe('speaker_send', ack.result())
+
+    async def send_json_via_websocket(self, json_data) -> asyncio.Future:
+        # queued on the persistent connection, the future resolves once speaker.bot acknowledged it
+        return await self.speaker.send(json_data)
 
 
 class Bot(commands.Bot):
 
-    def __init__(self, consumer: QueueConsumer, logger: Logger, no_command:bool = False):
+    def __init__(self, consumers, logger: Logger, no_command:bool = False):
         # Initialise our Bot with our access token, prefix and a list of channels to join on boot...
         # prefix can be a callable, which returns a list of strings or a string...
-        # initial_channels can also be a callable which returns a list of strings...
+        # consumers is a ConsumerRegistry or a single QueueConsumer, every channel a consumer answers is joined...
         self.l = logger
         self.l.passingblue('Spawning Bot')
-        self.queueConsumer = consumer
+        if not isinstance(consumers, ConsumerRegistry):
+            consumers = ConsumerRegistry(logger, consumers.shared, [consumers])
+        self.consumers = consumers
         self.no_command = no_command
-        super().__init__(token= creds.TWITCH_TOKEN, prefix='?', initial_channels=[creds.TWITCH_CHANNEL])
+        super().__init__(token= creds.TWITCH_TOKEN, prefix='?', initial_channels=self.consumers.channels())
 
     async def event_ready(self):
         # Notify us when everything is ready!
@@ -436,17 +692,20 @@ class Bot(commands.Bot):
         
     #returns true if response should be given
     
-    async def update_stream_info(self):
-        ch:ChannelInfo  = await self.fetch_channel(self.nick)
-        game = ch.game_name
-        title_parts = ch.title.split('|')
-        title = title_parts[0]
-        self.queueConsumer.set_stream_info(game, title)    
+    async def update_stream_info(self, channel: str = None):
+        for name in ([channel] if channel is not None else self.consumers.channels()):
+            ch:ChannelInfo  = await self.fetch_channel(name)
+            game = ch.game_name
+            title_parts = ch.title.split('|')
+            title = title_parts[0]
+            for consumer in self.consumers.get(name):
+                consumer.set_stream_info(game, title)
 
     async def event_message(self, message):
         # Messages with echo set to True are messages sent by the bot...
         # For now we just want to ignore them...
         self.l.info('Message recieved:')
+        consumers = self.consumers.get(message.channel.name)
         
         #if message.echo:
         #    return
@@ -455,48 +714,54 @@ class Bot(commands.Bot):
             if '!reload_prompt' in message.content:
                 self.l.warning('Reloading prompt')
                 
-                await self.queueConsumer.reload_prompt()
+                for consumer in consumers:
+                    await consumer.reload_prompt()
                 return
             
             if '!toggle_verbose' in message.content:
                 self.l.warning('Toggling Verbosity')
                 
-                await self.queueConsumer.toggle_verbosity()
+                for consumer in consumers:
+                    await consumer.toggle_verbosity()
                 return
             
             if '!clear_conv' in message.content:
                 self.l.warning('Clearing Conversation')
                 
-                await self.queueConsumer.clear_conv()
+                for consumer in consumers:
+                    await consumer.clear_conv()
                 return
             
             if '!update_info'in message.content:
                 self.l.warning('Updating Info')
-                await self.update_stream_info()
-                await self.queueConsumer.reload_prompt()
+                await self.update_stream_info(message.channel.name)
+                for consumer in consumers:
+                    await consumer.reload_prompt()
                 return
             
             if '!reload_all'in message.content:
                 self.l.warning('Reloading everything')
-                await self.update_stream_info()
-                await self.queueConsumer.reload_prompt()
-                await self.queueConsumer.clear_conv()
+                await self.update_stream_info(message.channel.name)
+                for consumer in consumers:
+                    await consumer.reload_prompt()
+                    await consumer.clear_conv()
                 return
             if '!enable_sally'in message.content:
                 self.l.warning('Enabling Sally')
-                self.queueConsumer.cooldown = 999999
-                self.queueConsumer.is_redeemed = True
+                for consumer in consumers:
+                    consumer.set_enabled(True)
                 return
             if '!disable_sally'in message.content:
                 self.l.warning('Disabling Sally')
-                self.queueConsumer.cooldown = 300
-                self.queueConsumer.is_redeemed = False
+                for consumer in consumers:
+                    consumer.set_enabled(False)
                 return
                 
         
         msg: str = f'{message.author.name}:  {message.content}'    
         self.l.info(msg)
-        await self.queueConsumer.put_message(message)
+        for consumer in consumers:
+            await consumer.put_message(message)
         
         
         
@@ -507,20 +772,25 @@ class Bot(commands.Bot):
 
   
 
-if __name__ == '__main__':
-
-
-    l = Logger(console_log=True, file_logging=True, file_URI='logs/logger.txt', override=True)
-    
-    consumer = QueueConsumer(logger=l, verbose=True, answer_rate=20, talk_to_self=False, prompt_path='prompt_chat.txt')
-    bot = Bot(consumer, l)
-    process = threading.Thread(target=consumer.run)
-    process.start()
-    
-
-
-    bot.run()
-    process.join()
-
+async def serve(l: Logger):
+    # all consumers and the bot share this loop, the bot has to be created on it
+    shared = SharedResources(l, verbose=True, metrics_port=9464)
+    if WORKER_PROCESSES:
+        pool = WorkerPool(l, SHARDS, processes=WORKER_PROCESSES, shared=shared, log_options=LOG_OPTIONS, metrics_port=9465)
+        consumers, run, stop = pool.consumers, pool.main, pool.close
+    else:
+        consumers = ConsumerRegistry(l, shared, [QueueConsumer(logger=l, shared=shared, **spec) for spec in SHARDS])
+        run, stop = consumers.main, consumers.close
+    bot = Bot(consumers, l)
+    supervisor = Supervisor(l)
+    supervisor.add('consumers', run, stop)
+    supervisor.add('twitch bot', bot.start, bot.close)
+    await supervisor.run()
 
 
+if __name__ == '__main__':
+    l = Logger(**LOG_OPTIONS)
+    try:
+        asyncio.run(serve(l))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,212 @@
+import asyncio
+import os
+from itertools import islice
+
+from json_handler import Journal, write_file_atomic
+from logger import Logger
+from retrieval import MemoryIndex
+
+
+class Memory:
+    """
+    Sally's long term memory, the memos she asked to remember with
+    write_memory{...}.
+
+    Memos are kept in an insertion ordered dict, so adding, removing and
+    looking them up is O(1). Every change is appended to a change log instead
+    of rewriting memory.txt, and a background task compacts the log into
+    memory.txt once it grew long enough. The number of memos and their total
+    length are capped so the memory block in the system prompt stays bounded.
+    Memos are also kept in a MemoryIndex, so relevant() can pick the ones
+    worth putting into the prompt.
+
+    Args:
+    - logger (Logger): Logger used for status output.
+    - path (str): The compacted memory file, one memo per line.
+    - log_path (str): The change log, '+memo' or '-memo' per line.
+    - max_memos (int): The most memos kept.
+    - max_chars (int): The most characters all memos together may have.
+    - policy (str): What is evicted when full, 'lru' for the least recently used or 'oldest'.
+    - compact_every (int): Change log lines after which memory.txt is rewritten.
+    """
+
+    def __init__(self, logger: Logger, path: str = 'memory.txt', log_path: str = 'memory.log', max_memos: int = 200,
+                 max_chars: int = 8000, policy: str = 'lru', compact_every: int = 50) -> None:
+        self.l = logger
+        self.path = path
+        self.log = Journal(log_path)
+        self.max_memos = max_memos
+        self.max_chars = max_chars
+        self.policy = policy
+        self.compact_every = compact_every
+        self.store = {}  # memo -> None, ordered from least to most recently used (or added)
+        self.index = MemoryIndex()
+        self.chars = 0
+        self.cached_string = None
+        self.log_lines = 0
+        self.compact_due = asyncio.Event()
+        self.closing = False
+        self.task = None
+
+    def load(self):
+        self.l.info('Loading Memory:')
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as file:
+                for memo in file.read().split('\n'):
+                    if memo != '':
+                        self._add(memo)
+        for path in self.log.replay_paths():
+            with open(path, 'r', encoding='utf-8') as log:
+                for line in log:
+                    line = line.rstrip('\n')
+                    if line.startswith('+'):
+                        self._add(line[1:])
+                    elif line.startswith('-'):
+                        self._discard(line[1:])
+                    self.log_lines += 1
+        for memo in self.store:
+            self.l.info(f'Appending: {memo}')
+        self.log.open()
+        self.evict()
+        if self.log_lines >= self.compact_every:
+            self.compact_due.set()
+
+    def _add(self, memo: str) -> bool:
+        if memo in self.store:
+            return False
+        self.store[memo] = None
+        self.index.add(memo)
+        self.chars += len(memo)
+        self.cached_string = None
+        return True
+
+    def _discard(self, memo: str) -> bool:
+        if memo not in self.store:
+            return False
+        del self.store[memo]
+        self.index.remove(memo)
+        self.chars -= len(memo)
+        self.cached_string = None
+        return True
+
+    def _write_log(self, line: str):
+        self.log.write(line)
+        self.log.flush()
+        self.log_lines += 1
+        if self.log_lines >= self.compact_every:
+            self.compact_due.set()
+
+    def append(self, memo: str) -> bool:
+        """
+        Remembers memo, evicting old memos if the memory is full.
+
+        Returns:
+        - bool: True if the memo was new.
+        """
+        memo = memo.strip()
+        if not memo:
+            return False
+        if not self._add(memo):
+            self.touch(memo)
+            return False
+        self._write_log(f'+{memo}')
+        self.evict()
+        return True
+
+    def remove(self, memo: str) -> bool:
+        """
+        Forgets memo.
+
+        Returns:
+        - bool: True if the memo was known.
+        """
+        if not self._discard(memo.strip()):
+            return False
+        self._write_log(f'-{memo.strip()}')
+        return True
+
+    def touch(self, memo: str):
+        # marks memo as just used, which keeps it from being evicted under the lru policy
+        if self.policy == 'lru' and memo in self.store:
+            del self.store[memo]
+            self.store[memo] = None
+
+    def evict(self):
+        while len(self.store) > 1 and (len(self.store) > self.max_memos or self.chars > self.max_chars):
+            victim = next(iter(self.store))
+            self._discard(victim)
+            self._write_log(f'-{victim}')
+            self.l.warning(f'Memory full, forgetting: {victim}')
+
+    @property
+    def memos(self) -> list:
+        return list(self.store)
+
+    def to_string(self):
+        if self.cached_string is None:
+            self.cached_string = ''.join(memo + '\n' for memo in self.store)
+        return self.cached_string
+
+    def relevant(self, query: str, k: int) -> str:
+        """
+        Picks the memos for the system prompt. If there are more than k, the
+        ones matching query best are used, the remaining slots are filled with
+        the most recently used memos.
+
+        Args:
+        - query (str): The recent conversation.
+        - k (int): The most memos returned.
+
+        Returns:
+        - str: The chosen memos, one per line.
+        """
+        if len(self.store) <= k:
+            return self.to_string()
+        chosen = self.index.top_k(query, k)
+        for memo in chosen:
+            self.touch(memo)
+        if len(chosen) < k:
+            picked = set(chosen)
+            recent = (memo for memo in reversed(self.store) if memo not in picked)
+            chosen.extend(islice(recent, k - len(chosen)))
+        return ''.join(memo + '\n' for memo in chosen)
+
+    def __len__(self):
+        return len(self.store)
+
+    def __contains__(self, memo):
+        return memo in self.store
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            await self.compact_due.wait()
+            await self.compact()
+            if self.closing:
+                return
+
+    async def compact(self):
+        """
+        Rewrites memory.txt from the current memos and starts a fresh change log.
+        """
+        self.compact_due.clear()
+        self.log_lines = 0
+        try:
+            await self.log.snapshot(write_file_atomic, self.path, self.to_string())
+        except OSError as e:
+            self.l.error(f'Unable to compact memory: {e}')
+            return
+        self.l.info(f'Compacted memory, {len(self.store)} memos')
+
+    async def close(self):
+        self.closing = True
+        if self.task is not None:
+            self.compact_due.set()  # the task compacts once more and returns
+            await self.task
+            self.task = None
+        elif self.log.file is not None:
+            await self.compact()
+        self.log.close()
@@ -0,0 +1,33 @@
+import time
+
+
+class CustomMessage:
+    author:str
+    content:str
+    plattform:str
+    answer:bool
+    
+    def __init__(self,author:str,content:str, plattform:str) -> None:
+        self.author = author
+        self.content = content
+        self.plattform = plattform
+        self.answer = False
+        self.received_at = time.time()  # when the line was written to the exchange file or arrived from twitch
+        self.queued_at = None
+        self.priority = 0  # see admission.py, higher is answered first
+
+    def to_wire(self) -> list:
+        """
+        Returns:
+        - list: The message as a JSON serialisable list, see from_wire.
+        """
+        return [self.author, self.content, self.plattform, self.answer, self.received_at, self.priority]
+
+    @classmethod
+    def from_wire(cls, data: list) -> 'CustomMessage':
+        author, content, plattform, answer, received_at, priority = data
+        message = cls(author, content, plattform)
+        message.answer = answer
+        message.received_at = received_at  # wall clock, so it stays meaningful in another process
+        message.priority = priority
+        return message
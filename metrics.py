@@ -0,0 +1,191 @@
+import asyncio
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from logger import Logger
+
+# upper bounds in seconds, from sub millisecond bookkeeping up to slow completions
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    """
+    Fixed bucket histogram, the same layout Prometheus uses.
+
+    Args:
+    - buckets (tuple): Sorted upper bounds of the buckets, +Inf is added implicitly.
+    """
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """
+        Returns the upper bound of the bucket the q-quantile falls into,
+        inf if it is beyond the last bucket.
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Metrics:
+    """
+    Latency histograms per pipeline stage, event counters and gauges.
+
+    Everything can be read as Prometheus text from a small local HTTP
+    endpoint, or written to the log as a periodic summary. Recording is
+    thread safe, so the recording code may run on any thread.
+
+    Args:
+    - logger (Logger): Logger the periodic summary is written to.
+    - prefix (str): Prefix of every exported metric name.
+    """
+
+    def __init__(self, logger: Logger, prefix: str = 'sally') -> None:
+        self.l = logger
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.stages = {}  # stage -> Histogram
+        self.counters = {}  # (name, label) -> count
+        self.gauges = {}  # (name, consumer) -> callable returning the current value
+        self.server = None
+        self.dump_task = None
+
+    def observe(self, stage: str, seconds: float):
+        with self.lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def increment(self, name: str, label: str = None, amount: int = 1):
+        with self.lock:
+            key = (name, label)
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def gauge(self, name: str, read, consumer: str = None):
+        """
+        Registers read() to be called whenever the gauge name is exported,
+        labelled with consumer if several consumers export the same gauge.
+        """
+        self.gauges[(name, consumer)] = read
+
+    def render(self) -> str:
+        """
+        Returns:
+        - str: All metrics in the Prometheus text exposition format.
+        """
+        name = f'{self.prefix}_stage_seconds'
+        lines = [f'# TYPE {name} histogram']
+        with self.lock:
+            for stage, histogram in sorted(self.stages.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {histogram.sum}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {histogram.count}')
+            typed = set()
+            for (counter, label), value in sorted(self.counters.items(), key=lambda item: (item[0][0], item[0][1] or '')):
+                full_name = f'{self.prefix}_{counter}_total'
+                if counter not in typed:
+                    lines.append(f'# TYPE {full_name} counter')
+                    typed.add(counter)
+                labels = f'{{outcome="{label}"}}' if label is not None else ''
+                lines.append(f'{full_name}{labels} {value}')
+        typed = set()
+        for (gauge, consumer), read in sorted(self.gauges.items(), key=lambda item: (item[0][0], item[0][1] or '')):
+            if gauge not in typed:
+                lines.append(f'# TYPE {self.prefix}_{gauge} gauge')
+                typed.add(gauge)
+            labels = f'{{consumer="{consumer}"}}' if consumer is not None else ''
+            lines.append(f'{self.prefix}_{gauge}{labels} {read()}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> str:
+        """
+        Returns:
+        - str: One line per stage with count, mean and approximate p50/p95/p99, then counters and gauges.
+        """
+        lines = []
+        with self.lock:
+            for stage, histogram in sorted(self.stages.items()):
+                mean = histogram.sum / histogram.count if histogram.count else 0.0
+                lines.append(f'{stage}: n={histogram.count} mean={mean * 1000:.1f}ms '
+                             f'p50<={histogram.quantile(0.5) * 1000:g}ms p95<={histogram.quantile(0.95) * 1000:g}ms '
+                             f'p99<={histogram.quantile(0.99) * 1000:g}ms')
+            counters = ' '.join(f'{name}{"." + label if label else ""}={value}' for (name, label), value in self.counters.items())
+        gauges = ' '.join(f'{name}{"." + consumer if consumer else ""}={read()}' for (name, consumer), read in self.gauges.items())
+        lines.append(f'{counters} {gauges}'.strip())
+        return '\n'.join(lines)
+
+    async def start(self, port: int = None, dump_interval: float = None, host: str = '127.0.0.1'):
+        """
+        Starts the HTTP endpoint on port and/or the periodic summary every
+        dump_interval seconds, both are off when None.
+        """
+        if port is not None and self.server is None:
+            self.server = await asyncio.start_server(self.handle_request, host, port)
+            self.l.passing(f'Serving metrics on http://{host}:{port}/metrics')
+        if dump_interval is not None and self.dump_task is None:
+            self.dump_task = asyncio.create_task(self.dump(dump_interval))
+
+    async def handle_request(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 5.0)
+            path = request.split(b' ', 2)[1] if request.count(b' ') >= 2 else b''
+            if path.split(b'?')[0] == b'/metrics':
+                status, body = '200 OK', self.render().encode()
+            else:
+                status, body = '404 Not Found', b'not found\n'
+            writer.write(f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                         f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def dump(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            self.l.passingblue(f'Pipeline stats:\n{self.summary()}')
+
+    async def close(self):
+        if self.dump_task is not None:
+            self.dump_task.cancel()
+            try:
+                await self.dump_task
+            except asyncio.CancelledError:
+                pass
+            self.dump_task = None
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
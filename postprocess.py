@@ -0,0 +1,152 @@
+import re
+from functools import lru_cache
+
+SENTENCE_ENDINGS = '.!?'
+TAG_STARTS = ('write_memory{', 'delete_memory{')
+
+
+@lru_cache(maxsize=None)
+def persona_patterns(persona: str) -> tuple:
+    """
+    Returns:
+    - tuple: (speaker prefixes, noise pattern) for responses of persona.
+    """
+    prefixes = tuple(f'{persona}{platform}:' for platform in ('', ' on Twitch', ' on YouTube', ' on Stream'))
+    # memory directives, the speaker prefix sometimes put in front of a response
+    # and underscores (read out awkwardly by the TTS), all removed in one scan
+    noise = re.compile(r'(write|delete)_memory\{([^}]*)\}|\A\s*' + re.escape(persona) + r'(?: on (?:Twitch|YouTube|Stream))?:|_')
+    return prefixes, noise
+
+
+UNCLOSED_TAG = re.compile(r'\w*\{[^}]*\Z')
+
+
+class SentenceSplitter:
+    """
+    Collects streamed completion deltas and hands out whole sentences as soon
+    as they are complete, so they can be spoken while the rest is generated.
+
+    A sentence ends at '.', '!' or '?' followed by whitespace, or at a line
+    break. Nothing is cut inside {...}, so write_memory{...} and
+    delete_memory{...} tags always stay in one piece.
+
+    Args:
+    - min_length (int): Sentences shorter than this are merged into the next one.
+    """
+
+    def __init__(self, min_length: int = 12) -> None:
+        self.min_length = min_length
+        self.buffer = ''
+        self.scanned = 0
+        self.depth = 0
+
+    def feed(self, delta: str) -> list:
+        """
+        Adds a delta from the stream.
+
+        Returns:
+        - list: The sentences completed by this delta, possibly empty.
+        """
+        self.buffer += delta
+        sentences = []
+        start = 0
+        i = self.scanned
+        while i < len(self.buffer):
+            char = self.buffer[i]
+            if char == '{':
+                self.depth += 1
+            elif char == '}':
+                self.depth = max(self.depth - 1, 0)
+            elif self.depth == 0 and i - start + 1 >= self.min_length:
+                if char == '\n' or (char.isspace() and i > start and self.buffer[i - 1] in SENTENCE_ENDINGS):
+                    sentence = self.buffer[start:i].strip()
+                    if sentence:
+                        sentences.append(sentence)
+                    start = i + 1
+            i += 1
+        self.buffer = self.buffer[start:]
+        self.scanned = len(self.buffer)
+        return sentences
+
+    def flush(self) -> str:
+        """
+        Returns whatever is left once the stream has ended and resets the splitter.
+        """
+        rest = self.buffer.strip()
+        self.buffer = ''
+        self.scanned = 0
+        self.depth = 0
+        return rest
+
+
+class ResponseProcessor:
+    """
+    Cleans a response for speaking and collects the memory directives in it,
+    write_memory{...} and delete_memory{...}, in the order they appear.
+
+    The response can be fed in streamed chunks of any size, text that might
+    still turn out to be part of a directive or of the speaker prefix is held
+    back until the next chunk decides it.
+
+    Args:
+    - persona (str): Name of the persona whose speaker prefix is removed.
+    """
+
+    def __init__(self, persona: str = 'Sally') -> None:
+        self.prefixes, self.noise = persona_patterns(persona)
+        self.buffer = ''
+        self.at_start = True
+        self.directives = []  # ('write' or 'delete', memo)
+
+    def feed(self, chunk: str) -> str:
+        """
+        Returns:
+        - str: The cleaned text that is safe to hand out so far.
+        """
+        self.buffer += chunk
+        safe = self._safe_length()
+        text = self.buffer[:safe]
+        self.buffer = self.buffer[safe:]
+        return self._clean(text)
+
+    def flush(self) -> str:
+        """
+        Returns the cleaned rest once the response has ended.
+        """
+        text = self.buffer
+        self.buffer = ''
+        return self._clean(text)
+
+    def process(self, response: str) -> str:
+        return self.feed(response) + self.flush()
+
+    def _safe_length(self) -> int:
+        buffer = self.buffer
+        if self.at_start:
+            head = buffer.lstrip()
+            if any(prefix.startswith(head) and prefix != head for prefix in self.prefixes):
+                return 0
+        unclosed = UNCLOSED_TAG.search(buffer)
+        if unclosed is not None:
+            return unclosed.start()
+        for n in range(min(len(buffer), len(TAG_STARTS[1]) - 1), 0, -1):
+            tail = buffer[-n:]
+            if any(tag.startswith(tail) for tag in TAG_STARTS):
+                return len(buffer) - n
+        return len(buffer)
+
+    def _replace(self, match) -> str:
+        if match.group(1) is not None:
+            # the memo may span lines, Memory stores one per line
+            self.directives.append((match.group(1), ' '.join(match.group(2).split())))
+            return ''
+        if match.group(0) == '_':
+            return ' '
+        return '' if self.at_start else match.group(0)
+
+    def _clean(self, text: str) -> str:
+        if not text:
+            return ''
+        cleaned = self.noise.sub(self._replace, text)
+        self.at_start = False
+        return cleaned
@@ -0,0 +1,67 @@
+from datetime import date, datetime, time, timedelta
+import time as _time
+
+
+class PromptBuilder:
+    """
+    Assembles the system prompt from cached segments: the prompt template with
+    the stream info filled in, today's date and the memory block. Every
+    segment is only rebuilt when it changes, so a request that finds nothing
+    changed reuses the previous prompt as is.
+    """
+
+    def __init__(self, template: str = '') -> None:
+        self.template = template
+        self.game = None
+        self.title = None
+        self.memory_block = ''
+        self.header = None  # template with STREAM_TITLE / GAME_NAME filled in
+        self.date = None
+        self.date_expires = 0.0
+        self.prompt = None
+
+    def set_template(self, template: str):
+        self.template = template
+        self.header = None
+        self.prompt = None
+
+    def set_stream_info(self, game: str, title: str):
+        self.game = game
+        self.title = title
+        self.header = None
+        self.prompt = None
+
+    def set_memory(self, memory_block: str):
+        if memory_block == self.memory_block:
+            return
+        self.memory_block = memory_block
+        self.prompt = None
+
+    def _update_date(self):
+        now = _time.time()
+        if now < self.date_expires:
+            return
+        self.date = datetime.today().strftime('%Y-%m-%d')
+        self.date_expires = datetime.combine(date.today() + timedelta(days=1), time.min).timestamp()
+        self.prompt = None
+
+    def _build_header(self) -> str:
+        header = self.template
+        if self.title is not None:
+            header = header.replace('STREAM_TITLE', self.title)
+        if self.game is not None:
+            header = header.replace('GAME_NAME', self.game)
+        return header
+
+    def build(self) -> dict:
+        """
+        Returns:
+        - dict: The system message, {'role': 'system', 'content': ...}.
+        """
+        self._update_date()
+        if self.prompt is None:
+            if self.header is None:
+                self.header = self._build_header()
+            self.prompt = {'role': 'system',
+                           'content': f'{self.header} DATE:{self.date} MEMORY: {self.memory_block}'}
+        return self.prompt
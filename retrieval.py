@@ -0,0 +1,84 @@
+import heapq
+import math
+import re
+from collections import Counter
+
+WORD = re.compile(r'[^\W_]+')
+STOPWORDS = frozenset((
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'do', 'for', 'from', 'has', 'have', 'he', 'her', 'his',
+    'i', 'if', 'in', 'is', 'it', 'its', 'me', 'my', 'no', 'not', 'of', 'on', 'or', 'she', 'so', 'that', 'the',
+    'their', 'them', 'they', 'this', 'to', 'was', 'we', 'were', 'what', 'with', 'you', 'your',
+))
+
+
+def tokenize(text: str) -> list:
+    return [word for word in WORD.findall(text.lower()) if word not in STOPWORDS]
+
+
+class MemoryIndex:
+    """
+    Inverted index over Sally's memos, ranked with BM25, so only the memos
+    relevant to the current conversation go into the system prompt.
+
+    The index is updated incrementally whenever a memo is added or removed,
+    a lookup only touches the postings of the words in the query.
+
+    Args:
+    - k1 (float): BM25 term frequency saturation.
+    - b (float): BM25 length normalization.
+    """
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75) -> None:
+        self.k1 = k1
+        self.b = b
+        self.postings = {}  # word -> {memo: count in memo}
+        self.lengths = {}  # memo -> number of words
+        self.total_length = 0
+
+    def add(self, memo: str):
+        if memo in self.lengths:
+            return
+        words = Counter(tokenize(memo))
+        for word, count in words.items():
+            self.postings.setdefault(word, {})[memo] = count
+        length = sum(words.values())
+        self.lengths[memo] = length
+        self.total_length += length
+
+    def remove(self, memo: str):
+        length = self.lengths.pop(memo, None)
+        if length is None:
+            return
+        self.total_length -= length
+        for word in set(tokenize(memo)):
+            posting = self.postings[word]
+            del posting[memo]
+            if not posting:
+                del self.postings[word]
+
+    def score(self, query: str) -> dict:
+        """
+        Returns:
+        - dict: memo -> BM25 score for every memo sharing a word with query.
+        """
+        scores = {}
+        if not self.lengths:
+            return scores
+        n = len(self.lengths)
+        average = self.total_length / n or 1
+        for word, query_count in Counter(tokenize(query)).items():
+            posting = self.postings.get(word)
+            if posting is None:
+                continue
+            idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+            for memo, count in posting.items():
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[memo] / average)
+                scores[memo] = scores.get(memo, 0.0) + query_count * idf * count * (self.k1 + 1) / (count + norm)
+        return scores
+
+    def top_k(self, query: str, k: int) -> list:
+        scores = self.score(query)
+        return heapq.nlargest(k, scores, key=scores.get)
+
+    def __len__(self):
+        return len(self.lengths)
@@ -0,0 +1,165 @@
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+from chat import CompletionClient
+from logger import Logger
+from metrics import Metrics
+from speaker import SpeakerConnection, SpeechPacer
+
+
+class FairScheduler:
+    """
+    Hands out a limited number of slots round robin between the shards
+    waiting for one, so a busy channel cannot starve a quiet one. Within a
+    shard slots go out first come, first served.
+
+    Args:
+    - slots (int): How many holders there may be at the same time.
+    """
+
+    def __init__(self, slots: int = 1) -> None:
+        self.slots = slots
+        self.in_use = 0
+        self.waiting = OrderedDict()  # shard -> deque of futures, in the order the shards get their turn
+
+    @asynccontextmanager
+    async def turn(self, shard: str):
+        if self.in_use < self.slots and not self.waiting:
+            self.in_use += 1
+        else:
+            granted = asyncio.get_running_loop().create_future()
+            self.waiting.setdefault(shard, deque()).append(granted)
+            try:
+                await granted
+            except asyncio.CancelledError:
+                if granted.done() and not granted.cancelled():
+                    self.release()  # the slot was handed over just as we were cancelled
+                else:
+                    self.forget(shard, granted)
+                raise
+        try:
+            yield
+        finally:
+            self.release()
+
+    def forget(self, shard: str, granted: asyncio.Future):
+        futures = self.waiting.get(shard)
+        if futures is not None and granted in futures:
+            futures.remove(granted)
+            if not futures:
+                del self.waiting[shard]
+
+    def release(self):
+        # the slot goes straight to the next shard in line, in_use stays the same
+        while self.waiting:
+            shard, futures = next(iter(self.waiting.items()))
+            granted = futures.popleft()
+            if futures:
+                self.waiting.move_to_end(shard)
+            else:
+                del self.waiting[shard]
+            if not granted.done():
+                granted.set_result(None)
+                return
+        self.in_use -= 1
+
+
+class SharedResources:
+    """
+    What all shards of one process share: the completion client and its
+    connection pool, the speaker.bot connection with its pacer, the metrics
+    and the schedulers deciding which shard may complete or speak next.
+    Counters and histograms are totals over all shards.
+
+    Args:
+    - logger (Logger): Logger used for status output.
+    - llm (CompletionClient): Completion client, an OpenAI one if None.
+    - speaker_bot_port (int): The speaker.bot websocket port.
+    - verbose (bool): Whether the speaker connection logs every packet.
+    - chars_per_second (float): Speaking rate used while speaker.bot sends no events.
+    - completion_slots (int): Completions that may be in flight at once over all shards.
+    - metrics_port (int): Port of the metrics endpoint, None for none.
+    - stats_interval (float): Seconds between logged metric summaries, None for none.
+    - speaker, pacer, speech: Replacements for the speaker connection, its pacer and the speech
+      scheduler, used by worker processes that speak through the main process, see workers.py.
+    """
+
+    def __init__(self, logger: Logger, llm: CompletionClient = None, speaker_bot_port: int = 7585, verbose: bool = False,
+                 chars_per_second: float = 10.0, completion_slots: int = 4, metrics_port: int = None,
+                 stats_interval: float = None, speaker: SpeakerConnection = None, pacer: SpeechPacer = None,
+                 speech: FairScheduler = None) -> None:
+        self.l = logger
+        self.llm = llm if llm is not None else CompletionClient(self.l)
+        self.speaker = speaker if speaker is not None else SpeakerConnection(self.l, port=speaker_bot_port, verbose=verbose)
+        # one voice output, so one pacer for everybody
+        self.pacer = pacer if pacer is not None else SpeechPacer(self.l, chars_per_second=chars_per_second)
+        self.speaker.add_listener(self.pacer.on_event)
+        self.metrics = Metrics(self.l)
+        self.completions = FairScheduler(completion_slots)
+        self.speech = speech if speech is not None else FairScheduler(1)
+        self.metrics_port = metrics_port
+        self.stats_interval = stats_interval
+
+    async def start(self):
+        self.speaker.start()
+        await self.metrics.start(self.metrics_port, self.stats_interval)
+
+    async def close(self):
+        await self.speaker.close()
+        await self.llm.close()
+        await self.metrics.close()
+
+
+class ConsumerRegistry:
+    """
+    The consumers (shards) running in this process, one per channel and
+    persona, and which Twitch channel feeds which of them. A channel may feed
+    several personas, every one of them sees all of its messages.
+
+    Args:
+    - logger (Logger): Logger used for status output.
+    - shared (SharedResources): What the consumers share, they must have been created with it.
+    - consumers (list): Consumers to register right away.
+    """
+
+    def __init__(self, logger: Logger, shared: SharedResources, consumers: list = ()) -> None:
+        self.l = logger
+        self.shared = shared
+        self.shards = {}  # name -> consumer
+        self.by_channel = {}  # channel -> consumers
+        for consumer in consumers:
+            self.add(consumer)
+
+    def add(self, consumer):
+        if consumer.name in self.shards:
+            raise ValueError(f'There already is a consumer named {consumer.name}')
+        if consumer.shared is not self.shared:
+            raise ValueError(f'Consumer {consumer.name} was created with other shared resources')
+        self.shards[consumer.name] = consumer
+        self.by_channel.setdefault(consumer.channel.lower(), []).append(consumer)
+        return consumer
+
+    def get(self, channel: str) -> list:
+        return self.by_channel.get(channel.lower(), [])
+
+    def channels(self) -> list:
+        return list(self.by_channel)
+
+    def __iter__(self):
+        return iter(self.shards.values())
+
+    def __len__(self):
+        return len(self.shards)
+
+    async def main(self):
+        self.l.passing(f'Running {len(self)} consumers: {", ".join(self.shards)}')
+        await self.shared.start()
+        try:
+            await asyncio.gather(*(consumer.main() for consumer in self))
+        finally:
+            await self.shared.close()
+
+    async def close(self):
+        for consumer in self:
+            await consumer.close()
@@ -0,0 +1,233 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict
+
+from websockets.asyncio.client import connect
+from websockets.exceptions import ConnectionClosed, InvalidHandshake
+
+from logger import Logger
+
+# speaker.bot events that tell us when an utterance finished playing
+SPEECH_EVENTS = {'General': ['SpeakStarted', 'SpeakCompleted']}
+
+
+class SpeakerConnection:
+    """
+    One long lived websocket connection to speaker.bot.
+
+    Packets are queued and sent by a background task that reconnects with
+    backoff whenever the connection drops, so a restart of speaker.bot only
+    delays speech instead of losing it. Websocket pings keep the connection
+    alive and detect dead peers. speaker.bot answers every request with the
+    same "id", which is used to report acknowledgements and round trip times.
+
+    Args:
+    - logger (Logger): Logger used for status output.
+    - port (int): The speaker.bot websocket port.
+    - path (str): The websocket path, '/speak' for the Sally setup.
+    - max_queue (int): Packets that may wait to be sent before send() blocks.
+    - heartbeat_interval (float): Seconds between websocket pings.
+    - ack_timeout (float): Seconds after which an unanswered packet is reported as lost.
+    - subscribe (dict): speaker.bot events to subscribe to after connecting, None for none.
+    """
+
+    def __init__(self, logger: Logger, port: int = 7585, path: str = '/speak', max_queue: int = 32,
+                 heartbeat_interval: float = 10.0, ack_timeout: float = 10.0, verbose: bool = False,
+                 subscribe: dict = SPEECH_EVENTS) -> None:
+        self.l = logger
+        self.url = f'ws://localhost:{port}{path}'
+        self.heartbeat_interval = heartbeat_interval
+        self.ack_timeout = ack_timeout
+        self.verbose = verbose
+        self.outbox = asyncio.Queue(maxsize=max_queue)
+        self.pending = {}  # id -> (time sent, future resolved with the latency)
+        self.latencies = OrderedDict()  # id -> latency in seconds, most recent last
+        self.unacknowledged = 0
+        self.subscribe = subscribe
+        self.listeners = []
+        self.websocket = None
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def send(self, data: dict) -> asyncio.Future:
+        """
+        Queues a packet, waiting if the outbox is full.
+
+        Returns:
+        - asyncio.Future: Resolves with the round trip time in seconds once
+          speaker.bot acknowledged the packet, or None if it never did.
+        """
+        self.start()
+        ack = asyncio.get_running_loop().create_future()
+        await self.outbox.put((data, ack))
+        return ack
+
+    async def run(self):
+        backoff = 0.5
+        packet = None
+        while True:
+            try:
+                async with connect(self.url, ping_interval=self.heartbeat_interval,
+                                   ping_timeout=self.heartbeat_interval) as websocket:
+                    self.websocket = websocket
+                    self.l.passing(f'Connected to speaker.bot at {self.url}')
+                    backoff = 0.5
+                    receiver = asyncio.create_task(self.receive(websocket))
+                    if self.subscribe:
+                        await websocket.send(json.dumps({'request': 'Subscribe', 'id': 'subscribe',
+                                                         'events': self.subscribe}))
+                    try:
+                        while True:
+                            if packet is None:
+                                packet = await self.outbox.get()
+                            await self.transmit(websocket, *packet)
+                            packet = None
+                    finally:
+                        receiver.cancel()
+            except (OSError, ConnectionClosed, InvalidHandshake, asyncio.TimeoutError) as e:
+                self.l.error(f'speaker.bot connection lost ({e}), reconnecting in {backoff}s')
+            finally:
+                self.websocket = None
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 10.0)
+
+    async def transmit(self, websocket, data: dict, ack: asyncio.Future):
+        _id = str(data.get('id'))
+        json_string = json.dumps(data)
+        self.expire()
+        self.pending[_id] = (time.perf_counter(), ack)
+        try:
+            await websocket.send(json_string)
+        except ConnectionClosed:
+            del self.pending[_id]
+            raise
+        self.l.info('Sent JSON data')
+        if self.verbose:
+            self.l.info(json_string)
+
+    async def receive(self, websocket):
+        try:
+            async for raw in websocket:
+                try:
+                    data = json.loads(raw)
+                except json.JSONDecodeError:
+                    self.l.warning(f'Unreadable message from speaker.bot: {raw}')
+                    continue
+                if isinstance(data.get('event'), dict):
+                    self.dispatch(data)
+                else:
+                    self.acknowledge(data)
+        except ConnectionClosed:
+            pass
+
+    def acknowledge(self, data: dict):
+        _id = str(data.get('id'))
+        self.expire()
+        if _id not in self.pending:
+            return
+        sent_at, ack = self.pending.pop(_id)
+        latency = time.perf_counter() - sent_at
+        self.latencies[_id] = latency
+        while len(self.latencies) > 1000:
+            self.latencies.popitem(last=False)
+        if not ack.done():
+            ack.set_result(latency)
+        self.l.info(f'Packet {_id} acknowledged after {latency * 1000:.1f}ms ({data.get("status", "no status")})',
+                    printout=self.verbose)
+
+    def add_listener(self, listener):
+        """
+        Registers listener(event_type, data) to be called for every speaker.bot event.
+        """
+        self.listeners.append(listener)
+
+    def dispatch(self, data: dict):
+        event_type = data['event'].get('type')
+        for listener in self.listeners:
+            listener(event_type, data)
+
+    def expire(self):
+        now = time.perf_counter()
+        for _id, (sent_at, ack) in list(self.pending.items()):
+            if now - sent_at > self.ack_timeout:
+                del self.pending[_id]
+                self.unacknowledged += 1
+                if not ack.done():
+                    ack.set_result(None)
+                self.l.warning(f'Packet {_id} was never acknowledged by speaker.bot')
+
+    async def close(self):
+        if self.websocket is not None:
+            await self.websocket.close()
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+
+class SpeechPacer:
+    """
+    Keeps track of whether speaker.bot is still talking, so the next answer
+    is only spoken once the current one finished.
+
+    Completion events from speaker.bot are used when they arrive. Until the
+    first one was seen, the playing time is estimated from the text length.
+    Once events are known to work the estimate only serves as a safety net.
+
+    Args:
+    - logger (Logger): Logger used for status output.
+    - chars_per_second (float): Speaking rate used for the estimate.
+    - completed_events (tuple): Event types that mark the end of an utterance.
+    """
+
+    def __init__(self, logger: Logger, chars_per_second: float = 10.0, completed_events: tuple = ('SpeakCompleted',)) -> None:
+        self.l = logger
+        self.chars_per_second = chars_per_second
+        self.completed_events = completed_events
+        self.outstanding = 0
+        self.estimated_end = 0.0
+        self.events_seen = False
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    def estimate(self, text: str) -> float:
+        return len(text) / self.chars_per_second
+
+    def started(self, text: str):
+        now = time.monotonic()
+        self.estimated_end = max(now, self.estimated_end) + self.estimate(text)
+        self.outstanding += 1
+        self.idle.clear()
+
+    def on_event(self, event_type: str, data: dict):
+        if event_type not in self.completed_events:
+            return
+        self.events_seen = True
+        self.outstanding = max(self.outstanding - 1, 0)
+        if self.outstanding == 0:
+            self.estimated_end = time.monotonic()
+            self.idle.set()
+
+    @property
+    def speaking(self) -> bool:
+        return self.outstanding > 0
+
+    async def wait_idle(self):
+        if not self.speaking:
+            return
+        remaining = max(self.estimated_end - time.monotonic(), 0)
+        timeout = remaining * 2 + 5 if self.events_seen else remaining
+        try:
+            await asyncio.wait_for(self.idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            if self.events_seen:
+                self.l.warning('No speech completion event from speaker.bot, continuing anyway')
+            self.outstanding = 0
+            self.idle.set()
@@ -1,16 +1,15 @@
 from asyncio import Queue
 import asyncio
-import threading
-import websockets
 from twitchio.ext import commands
 from twitchio import ChannelInfo
 from chat import *
-import time
 import random
 import creds
-import json
 from json_handler import *
 from logger import Logger
+from ingestion import ExchangeTail, ExchangeWatcher
+from speaker import SpeakerConnection, SpeechPacer
+from supervisor import Supervisor
 
 
 CONVERSATION_LIMIT = 40
@@ -43,8 +42,15 @@ class QueueConsumer:
         self.queue = Queue()
         self.no_command = no_command
         self.port = speaker_bot_port
+        self.speaker = SpeakerConnection(self.l, port=self.port, path='', verbose=self.verbose)
+        self.pacer = SpeechPacer(self.l)
+        self.speaker.add_listener(self.pacer.on_event)
         self.speaker_alias = speaker_alias
         self.answer_rate = answer_rate
+        self.llm = CompletionClient(self.l)  # async, so a completion does not stall the twitch bot on the same loop
+        self.activity = asyncio.Event()  # set when a twitch message was queued
+        self.tails = {name: ExchangeTail(name, self.l) for name in ('chat_exchange.txt', 'streamer_exchange.txt')}
+        self.closing = False
         pass
     
     def run(self):
@@ -66,8 +72,10 @@ class QueueConsumer:
                 "ignored_users": []
                 }
             write_to_json_file(dummy_filter, 'filter.json')
+        watcher = ExchangeWatcher(list(self.tails), self.l)
+        self.speaker.start()
         try:
-            while (True):
+            while not self.closing:
                 
                 if not self.queue.empty():
                     message: CustomMessage = await self.queue.get()
@@ -80,15 +88,37 @@ class QueueConsumer:
                     
                     if not await self.check_completion(message): #checks for already answered messages
                         await self.request_completion(message) #requests chatGPT completion
-                        await asyncio.sleep(len(message.content)/10)
                         continue
                 await self.youtube_chat() #check for new Youtube chat messages
                 await self.voice_control() #check for new Voice commands
+                if self.queue.empty() and not self.closing:
+                    await self.wait_for_activity(watcher) # idle until the exchange files change or a twitch message arrives
                     
         except Exception as e:
             self.l.fail(f'Exception in main loop: {e}')
+        finally:
+            watcher.close()
+            for tail in self.tails.values():
+                tail.close()
+            await self.speaker.close()
+            await self.llm.close()
             
             
+    async def wait_for_activity(self, watcher: ExchangeWatcher):
+        # come back for half written lines even if the writer goes quiet
+        partial = any(tail.has_partial for tail in self.tails.values())
+        waiters = [asyncio.create_task(watcher.wait(0.5 if partial else None)), asyncio.create_task(self.activity.wait())]
+        try:
+            await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for waiter in waiters:
+                waiter.cancel()
+        self.activity.clear()
+
+    async def close(self):
+        self.closing = True
+        self.activity.set()
+
     async def voice_control(self):
         
         await self.file2queue('streamer_exchange.txt', 'Stream')       
@@ -98,32 +128,17 @@ class QueueConsumer:
         await self.file2queue('chat_exchange.txt', 'YouTube')
         
     async def file2queue(self,file_uri:str, plattform:str):
-        file_contents = open_file(file_uri)
-        if len(file_contents) < 1:
-            return
-        lines = file_contents.split('\n')
-        for line in lines:
-            if len(line) <1:
-                continue
+        # only what was appended since the last read, nothing is truncated under the writer
+        for line in self.tails[file_uri].read_lines():
             contents = line.split(';msg:')
+            if len(contents) < 2:
+                self.l.warning(f'Skipping malformed line in {file_uri}: {line!r}')
+                continue
             msg = CustomMessage(contents[0], contents[1], plattform)
             msg.answer = await self.response_decision(msg)
             await self.queue.put(msg)
-            
-        self.delete_file_contents(file_uri)
-        
-        self.l.userReply(msg.author,msg.plattform , msg.content)  
+            self.l.userReply(msg.author,msg.plattform , msg.content)
         
-    def delete_file_contents(self, file_path):
-        try:
-            # Open the file in write mode, which truncates the file
-            with open(file_path, 'w'):
-                pass  # Using pass to do nothing inside the with block
-            self.l.passing("Contents of '{}' have been deleted.".format(file_path))
-        except IOError:
-            self.l.error("Unable to delete contents of '{}'.".format(file_path))
-            
-            
     async def put_message(self, message): # Only for twitch Message Objects! Not custom message
         author = message.author.name
         msg = message.content
@@ -131,6 +146,7 @@ class QueueConsumer:
         new_msg = CustomMessage(author, msg, 'Twitch')
         new_msg.answer = await self.response_decision(new_msg)
         await self.queue.put(new_msg)
+        self.activity.set()
         
     async def reload_prompt(self):
         self.l.passingblue('Reloading Prompt')
@@ -138,6 +154,7 @@ class QueueConsumer:
     
     async def toggle_verbosity(self):
         self.verbose = not self.verbose
+        self.speaker.verbose = self.verbose
         self.l.passingblue(f'Verbosity is now: {self.verbose}')
     
     async def clear_conv(self):
@@ -166,7 +183,7 @@ class QueueConsumer:
         
         self.l.warning('--------------\nMessage being processed')
         self.l.userReply(message.author, message.plattform, message.content)
-        self.l.info(self.conversation, printout = self.verbose)
+        self.l.info(lambda entries=list(self.conversation): repr(entries), printout = self.verbose)
         n:str = message.author
         cleaned_name = n.replace('_',' ')
 
@@ -178,7 +195,10 @@ class QueueConsumer:
         if not message.answer:
             self.l.info('Message appended, not answering', printout = self.verbose)
             return
-        response:str = gpt3_completion(self.system_prompt , self.conversation, self.l, verbose = self.verbose)
+        response = await self.llm.complete(self.system_prompt , self.conversation, verbose = self.verbose)
+        if response is None:
+            self.l.warning('No completion, waiting for next message...\n--------------')
+            return
         response = response.replace('_', ' ') # replace _ with SPACE to make TTS less jarring
         
         #All of the following checks are dependend on your prompt
@@ -201,8 +221,6 @@ class QueueConsumer:
         if len(self.conversation) > CONVERSATION_LIMIT:
             self.conversation = self.conversation[1:]
         
-        time.sleep(len(response)/10)
-        
         self.l.warning('Cooldown ended, waiting for next message...\n--------------')
         
     async def response_decision(self, msg:CustomMessage) -> bool:
@@ -241,6 +259,7 @@ class QueueConsumer:
         
     async def speak(self, message):
         
+        await self.pacer.wait_idle() # wait for the previous answer to finish playing
         id = random.randrange(10000,99999)
         
         data = {
@@ -252,20 +271,12 @@ class QueueConsumer:
         
         self.l.info(f"Sending Packet with ID {id}")
         
+        self.pacer.started(message)
         await self.send_json_via_websocket(data)
         
 
     async def send_json_via_websocket(self, json_data):
-        async with websockets.connect((f'ws://localhost:{self.port}')) as websocket:
-            # Convert JSON data to string
-            json_string = json.dumps(json_data)
-            
-            # Send JSON string via WebSocket
-            await websocket.send(json_string)
-            self.l.info(f"Sent JSON data")
-            if self.verbose:
-                self.l.info(json_string)
-            await websocket.close()
+        return await self.speaker.send(json_data)
               
 
 
@@ -355,20 +366,19 @@ class Bot(commands.Bot):
 
   
 
-if __name__ == '__main__':
-
-
-    l = Logger(console_log=True, file_logging=True, file_URI='logs/logger.txt', override=True)
-    
+async def serve(l: Logger):
+    # the consumer and the bot share this loop, the bot has to be created on it
     consumer = QueueConsumer(logger=l, verbose=True, answer_rate=20)
     bot = Bot(consumer, l)
-    process = threading.Thread(target=consumer.run)
-    process.start()
-    
-
-
-    bot.run()
-    process.join()
-
+    supervisor = Supervisor(l)
+    supervisor.add('consumer', consumer.main, consumer.close)
+    supervisor.add('twitch bot', bot.start, bot.close)
+    await supervisor.run()
 
 
+if __name__ == '__main__':
+    l = Logger(console_log=True, file_logging=True, file_URI='logs/logger.txt', override=True, buffered=True)
+    try:
+        asyncio.run(serve(l))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,84 @@
+import asyncio
+import signal
+
+from logger import Logger
+
+
+class Supervisor:
+    """
+    Runs the long lived parts of the bot (the twitch connection, the queue
+    consumer, ...) as tasks on one event loop.
+
+    As soon as one of them ends, fails, or SIGINT/SIGTERM arrives, the others
+    are stopped in reverse order: their stop coroutine is awaited if they
+    have one, whatever is still running after grace seconds is cancelled.
+
+    Args:
+    - logger (Logger): Logger used for status output.
+    - grace (float): Seconds a service gets to finish after being asked to stop.
+    """
+
+    def __init__(self, logger: Logger, grace: float = 5.0) -> None:
+        self.l = logger
+        self.grace = grace
+        self.services = []  # (name, run, stop)
+        self.stopping = None
+
+    def add(self, name: str, run, stop=None):
+        """
+        Args:
+        - name (str): Used in log messages.
+        - run: Coroutine function running the service until it is done.
+        - stop: Optional coroutine function asking the service to finish.
+        """
+        self.services.append((name, run, stop))
+
+    def stop(self):
+        if self.stopping is not None:
+            self.stopping.set()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        handled = []
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.stop)
+                handled.append(sig)
+            except (NotImplementedError, RuntimeError):
+                pass  # not supported on Windows, Ctrl+C cancels asyncio.run instead
+        tasks = [(asyncio.create_task(run(), name=name), name, stop) for name, run, stop in self.services]
+        stopper = asyncio.create_task(self.stopping.wait())
+        try:
+            done, _ = await asyncio.wait([task for task, _, _ in tasks] + [stopper], return_when=asyncio.FIRST_COMPLETED)
+            for task, name, _ in tasks:
+                if task in done:
+                    self.report(task, name)
+        finally:
+            stopper.cancel()
+            for sig in handled:
+                loop.remove_signal_handler(sig)
+            await self.shutdown(tasks)
+
+    def report(self, task: asyncio.Task, name: str):
+        if task.cancelled():
+            self.l.warning(f'{name} was cancelled, shutting down')
+        elif task.exception() is not None:
+            self.l.fail(f'{name} failed: {task.exception()!r}, shutting down')
+        else:
+            self.l.warning(f'{name} stopped, shutting down')
+
+    async def shutdown(self, tasks: list):
+        for task, name, stop in reversed(tasks):
+            if task.done():
+                continue
+            self.l.passingblue(f'Stopping {name}')
+            if stop is not None:
+                try:
+                    await asyncio.wait_for(stop(), self.grace)
+                except Exception as e:
+                    self.l.error(f'Unable to stop {name} cleanly: {e!r}')
+                await asyncio.wait({task}, timeout=self.grace)
+            if not task.done():
+                task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
@@ -0,0 +1,152 @@
+import os
+
+import pytest
+
+from ingestion import ExchangeTail
+from logger import Logger
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'chat_exchange.txt')
+
+
+def append(path, data: bytes):
+    with open(path, 'ab') as file:
+        file.write(data)
+
+
+def make_tail(path, rotate_size=16 * 1024):
+    return ExchangeTail(path, Logger(), rotate_size=rotate_size)
+
+
+def started(path, rotate_size=16 * 1024):
+    # the first read consumes and rotates away what was there before startup
+    tail = make_tail(path, rotate_size)
+    assert tail.read_lines() == []
+    return tail
+
+
+def test_reads_only_appended_lines(path):
+    append(path, b'before;msg:startup\n')
+    tail = make_tail(path)
+    assert tail.read_lines() == ['before;msg:startup']
+    assert not os.path.exists(path)
+    append(path, b'a;msg:one\nb;msg:two\n')
+    assert tail.read_lines() == ['a;msg:one', 'b;msg:two']
+    append(path, b'c;msg:three\n')
+    assert tail.read_lines() == ['c;msg:three']
+    assert tail.read_lines() == []
+
+
+def test_partial_line_waits_for_the_writer(path):
+    tail = started(path)
+    append(path, b'a;msg:one\nb;msg:tw')
+    assert tail.read_lines() == ['a;msg:one']
+    assert tail.has_partial
+    append(path, b'o\n')
+    assert tail.read_lines() == ['b;msg:two']
+    assert not tail.has_partial
+
+
+def test_unfinished_partial_line_is_taken_on_the_second_unchanged_read(path):
+    tail = started(path)
+    append(path, b'a;msg:one\nb;msg:two')
+    assert tail.read_lines() == ['a;msg:one']
+    assert tail.read_lines() == ['b;msg:two']
+    assert tail.read_lines() == []
+
+
+def test_partial_line_is_carried_across_rotation(path):
+    tail = started(path, rotate_size=16)
+    append(path, b'a;msg:long enough to rotate\nb;msg:tw')
+    assert tail.read_lines() == ['a;msg:long enough to rotate']
+    assert not os.path.exists(path)
+    assert not os.path.exists(path + '.consumed')
+    append(path, b'o\nc;msg:three\n')
+    assert tail.read_lines() == ['b;msg:two', 'c;msg:three']
+
+
+def test_lines_appended_after_the_last_read_survive_rotation(path):
+    tail = started(path, rotate_size=16)
+    append(path, b'a;msg:one\n')
+    assert tail.read_lines() == ['a;msg:one']
+    # appended after the read, rotated together with what was already read
+    append(path, b'b;msg:two is long\n')
+    assert tail.read_lines() == ['b;msg:two is long']
+    append(path, b'c;msg:three\n')
+    assert tail.read_lines() == ['c;msg:three']
+
+
+def test_close_keeps_the_position_for_the_next_start(path):
+    tail = started(path)
+    append(path, b'a;msg:one\n')
+    assert tail.read_lines() == ['a;msg:one']
+    append(path, b'b;msg:two\n')
+    tail.close()
+    assert os.path.exists(path + '.position')
+    restarted = make_tail(path)
+    assert not os.path.exists(path + '.position')
+    assert restarted.read_lines() == ['b;msg:two']
+
+
+def test_position_of_a_replaced_file_is_ignored(path):
+    tail = started(path)
+    append(path, b'a;msg:one\n')
+    assert tail.read_lines() == ['a;msg:one']
+    tail.close()
+    os.remove(path)
+    append(path, b'b;msg:two\n')
+    assert make_tail(path).read_lines() == ['b;msg:two']
+
+
+def test_close_puts_back_what_was_not_handed_out(path):
+    with open(path + '.consumed', 'wb') as file:
+        file.write(b'a;msg:one\nb;msg:tw')
+    tail = make_tail(path)
+    tail.close()  # before the first read
+    restarted = make_tail(path)
+    append(path, b'o\n')
+    assert restarted.read_lines() == ['a;msg:one', 'b;msg:two']
+
+
+def test_leftover_consumed_file_is_handed_out_first(path):
+    with open(path + '.consumed', 'wb') as file:
+        file.write(b'a;msg:one\nb;msg:tw')
+    tail = make_tail(path)
+    assert not os.path.exists(path + '.consumed')
+    append(path, b'o\nc;msg:three\n')
+    assert tail.read_lines() == ['a;msg:one', 'b;msg:two', 'c;msg:three']
+
+
+def test_replaced_file_is_read_from_the_start(path):
+    tail = started(path)
+    append(path, b'a;msg:one\n')
+    assert tail.read_lines() == ['a;msg:one']
+    replacement = path + '.new'
+    append(replacement, b'b;msg:two\nc;msg:three\n')
+    os.replace(replacement, path)
+    assert tail.read_lines() == ['b;msg:two', 'c;msg:three']
+
+
+def test_truncated_file_is_read_from_the_start(path):
+    tail = started(path)
+    append(path, b'a;msg:a longer first line\n')
+    assert tail.read_lines() == ['a;msg:a longer first line']
+    with open(path, 'wb') as file:
+        file.write(b'b;msg:two\n')
+    assert tail.read_lines() == ['b;msg:two']
+
+
+def test_malformed_lines(path):
+    tail = started(path)
+    append(path, b'\n\r\na;msg:\xff\xfeone\r\n\nno separator\n')
+    assert tail.read_lines() == ['a;msg:��one', 'no separator']
+
+
+def test_missing_file(path):
+    tail = make_tail(path)
+    assert tail.read_lines() == []
+    assert not tail.has_partial
+    tail.close()
+    assert not os.path.exists(path + '.position')
@@ -0,0 +1,297 @@
+import abc
+import asyncio
+import ctypes
+import itertools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import escape
+
+
+class Utterance:
+    """
+    Synthesized speech.
+
+    Args:
+    - text (str): What is said.
+    - audio (bytes): The encoded audio, MP3 for Google.
+    - marks (list): (word, seconds from the start) for every word, in order.
+    - duration (float): Length in seconds if known.
+    """
+
+    def __init__(self, text: str, audio: bytes, marks: list, duration: float = None) -> None:
+        self.text = text
+        self.audio = audio
+        self.marks = marks
+        self.duration = duration
+
+
+class Synthesizer(abc.ABC):
+    """
+    Turns text into an Utterance. synthesize() may block, SpeechEngine
+    calls it on a worker thread.
+    """
+
+    @abc.abstractmethod
+    def synthesize(self, text: str) -> Utterance:
+        ...
+
+
+class GoogleSynthesizer(Synthesizer):
+    """
+    Google Cloud Text-to-Speech with an SSML mark before every word, so the
+    captions can follow along. One client is created and reused, it is
+    safe to use from several threads.
+
+    Args:
+    - language_code (str): Language of the voice.
+    - voice_name (str): The Google voice.
+    - gender (str): SsmlVoiceGender name of the voice.
+    """
+
+    def __init__(self, language_code: str = 'en-GB', voice_name: str = 'en-GB-Wavenet-B', gender: str = 'MALE') -> None:
+        from google.cloud import texttospeech_v1beta1 as texttospeech  # only needed for the real thing
+        self.texttospeech = texttospeech
+        self.client = texttospeech.TextToSpeechClient()
+        self.voice = texttospeech.VoiceSelectionParams(
+            language_code=language_code,
+            name=voice_name,
+            ssml_gender=texttospeech.SsmlVoiceGender[gender],
+        )
+        self.audio_config = texttospeech.AudioConfig(audio_encoding=texttospeech.AudioEncoding.MP3)
+
+    def synthesize(self, text: str) -> Utterance:
+        words = text.split(' ')
+        ssml = '<speak>' + ''.join(f'<mark name="{i}"/>{escape(word)}' for i, word in enumerate(words)) + '</speak>'
+        response = self.client.synthesize_speech(
+            request={"input": self.texttospeech.SynthesisInput(ssml=ssml), "voice": self.voice,
+                     "audio_config": self.audio_config, "enable_time_pointing": ["SSML_MARK"]}
+        )
+        marks = [(words[int(point.mark_name)], point.time_seconds) for point in response.timepoints]
+        return Utterance(text, response.audio_content, marks)
+
+
+class StubSynthesizer(Synthesizer):
+    """
+    Produces no audio, only word timings at a fixed speaking rate, for
+    testing without Google credentials or network. Use it with SilentPlayer.
+
+    Args:
+    - chars_per_second (float): Speaking rate the timings are based on.
+    - latency (float): Seconds every synthesis takes.
+    """
+
+    def __init__(self, chars_per_second: float = 15.0, latency: float = 0.0) -> None:
+        self.chars_per_second = chars_per_second
+        self.latency = latency
+
+    def synthesize(self, text: str) -> Utterance:
+        if self.latency:
+            time.sleep(self.latency)
+        marks = []
+        at = 0.0
+        for word in text.split(' '):
+            marks.append((word, at))
+            at += (len(word) + 1) / self.chars_per_second
+        return Utterance(text, b'', marks, duration=at)
+
+
+class SilentPlayer:
+    """
+    Plays nothing, just takes as long as the utterance, for testing.
+    """
+
+    async def play(self, utterance: Utterance):
+        await asyncio.sleep(utterance.duration or 0.0)
+
+    def close(self):
+        pass
+
+
+class VlcPlayer:
+    """
+    Plays utterances with VLC straight from memory through libvlc's media
+    callbacks, no file is written. play() returns once VLC reached the end.
+    """
+
+    def __init__(self) -> None:
+        import vlc
+        self.vlc = vlc
+        self.instance = vlc.Instance()
+        self.player = self.instance.media_player_new()
+        self.streams = {}  # key -> [audio, read position], read from VLC's threads
+        self.keys = itertools.count(1)  # 0 would arrive as a NULL pointer
+        self.loop = None
+        self.done = None
+        # kept referenced, VLC calls them for as long as media exist
+        self.callbacks = (vlc.CallbackDecorators.MediaOpenCb(self._open), vlc.CallbackDecorators.MediaReadCb(self._read),
+                          vlc.CallbackDecorators.MediaSeekCb(self._seek), vlc.CallbackDecorators.MediaCloseCb(self._close))
+        events = self.player.event_manager()
+        events.event_attach(vlc.EventType.MediaPlayerEndReached, self._on_end)
+        events.event_attach(vlc.EventType.MediaPlayerEncounteredError, self._on_end)
+
+    async def play(self, utterance: Utterance):
+        self.loop = asyncio.get_running_loop()
+        self.done = self.loop.create_future()
+        key = next(self.keys)
+        self.streams[key] = [utterance.audio, 0]
+        media = self.instance.media_new_callbacks(*self.callbacks, ctypes.c_void_p(key))
+        self.player.set_media(media)
+        self.player.play()
+        try:
+            await self.done
+        finally:
+            self.player.stop()
+            media.release()
+            self.streams.pop(key, None)
+
+    def _on_end(self, event):
+        # called on a VLC thread, which must not call back into libvlc
+        self.loop.call_soon_threadsafe(self._finish)
+
+    def _finish(self):
+        if self.done is not None and not self.done.done():
+            self.done.set_result(None)
+
+    def _open(self, opaque, datap, sizep):
+        stream = self.streams.get(opaque)
+        if stream is None:
+            return -1
+        stream[1] = 0
+        datap.contents.value = opaque
+        sizep.contents.value = len(stream[0])
+        return 0
+
+    def _read(self, opaque, buffer, length):
+        stream = self.streams.get(opaque)
+        if stream is None:
+            return -1
+        audio, position = stream
+        chunk = audio[position:position + length]
+        ctypes.memmove(buffer, chunk, len(chunk))
+        stream[1] = position + len(chunk)
+        return len(chunk)
+
+    def _seek(self, opaque, offset):
+        stream = self.streams.get(opaque)
+        if stream is None:
+            return -1
+        stream[1] = min(offset, len(stream[0]))
+        return 0
+
+    def _close(self, opaque):
+        pass
+
+    def close(self):
+        self.player.release()
+        self.instance.release()
+
+
+class Captions:
+    """
+    Writes the words of an utterance to a text file as they are spoken,
+    for a text source in OBS.
+
+    Args:
+    - path (str): The captions file.
+    - line_words (int): Words per line.
+    - screen_words (int): Words after which the file is cleared.
+    - linger (float): Seconds the last words stay after the utterance ended.
+    """
+
+    def __init__(self, path: str = 'output.txt', line_words: int = 7, screen_words: int = 25, linger: float = 2.0) -> None:
+        self.path = path
+        self.line_words = line_words
+        self.screen_words = screen_words
+        self.linger = linger
+
+    def write(self, text: str):
+        with open(self.path, 'a', encoding='utf-8') as out:
+            out.write(text)
+
+    def clear(self):
+        open(self.path, 'w', encoding='utf-8').close()
+
+    async def show(self, marks: list):
+        start = time.monotonic()
+        count = 0
+        for word, at in marks:
+            await asyncio.sleep(max(at - (time.monotonic() - start), 0.0))
+            self.write(word + ' ')
+            count += 1
+            if count == self.screen_words:
+                self.clear()
+                count = 0
+            elif count % self.line_words == 0:
+                self.write('\n')
+
+    async def finish(self):
+        await asyncio.sleep(self.linger)
+        self.clear()
+
+
+class SpeechEngine:
+    """
+    Speaks texts one after another without blocking the event loop.
+
+    Synthesis starts on a worker thread as soon as a text is queued, so the
+    next utterance is usually ready by the time the current one finished
+    playing. Playback and captions run on the event loop.
+
+    Args:
+    - synthesizer (Synthesizer): Where the audio comes from.
+    - player: Has an async play(utterance) and close(), a VlcPlayer if None.
+    - captions (Captions): Captions written along, None for none.
+    - workers (int): Syntheses that may run at the same time.
+    - prefetch (int): Utterances that may wait for playback before say() blocks.
+    """
+
+    def __init__(self, synthesizer: Synthesizer, player = None, captions: Captions = None, workers: int = 2, prefetch: int = 2) -> None:
+        self.synthesizer = synthesizer
+        self.player = player if player is not None else VlcPlayer()
+        self.captions = captions
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='tts')
+        self.pending = asyncio.Queue(maxsize=prefetch)  # futures of the utterances, in the order they are spoken
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def say(self, text: str):
+        """
+        Queues text to be spoken, returns once its synthesis started.
+        """
+        self.start()
+        synthesis = asyncio.get_running_loop().run_in_executor(self.executor, self.synthesizer.synthesize, text)
+        await self.pending.put(synthesis)
+
+    async def run(self):
+        while True:
+            synthesis = await self.pending.get()
+            try:
+                utterance = await synthesis
+            except Exception as e:
+                print(f'Speech synthesis failed: {e}')
+                continue
+            try:
+                await self.speak(utterance)
+            except Exception as e:
+                print(f'Playback failed: {e}')
+
+    async def speak(self, utterance: Utterance):
+        if self.captions is None:
+            await self.player.play(utterance)
+            return
+        await asyncio.gather(self.player.play(utterance), self.captions.show(utterance.marks))
+        await self.captions.finish()
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.player.close()
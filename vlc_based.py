@@ -3,12 +3,11 @@ import random
 from twitchio.ext import commands
 import websockets
 from chat import *
-from google.cloud import texttospeech_v1beta1 as texttospeech
-import vlc
 import os 
-import time
-import nltk
 import creds
+from logger import Logger
+from english_filter import EnglishFilter
+from tts import SpeechEngine, GoogleSynthesizer, VlcPlayer, Captions
 
 
 CONVERSATION_LIMIT = 20
@@ -17,20 +16,28 @@ class Bot(commands.Bot):
 
     conversation = list()
 
-    def __init__(self, speaker_bot = False, speaker_alias = 'Default'):
+    def __init__(self, speaker_bot = False, speaker_alias = 'Default', speech: SpeechEngine = None):
         # Initialise our Bot with our access token, prefix and a list of channels to join on boot...
         # prefix can be a callable, which returns a list of strings or a string...
         # initial_channels can also be a callable which returns a list of strings...
         
-        Bot.conversation.append({ 'role': 'system', 'content': open_file('prompt_chat.txt') })
+        self.system_prompt = { 'role': 'system', 'content': open_file('prompt_chat.txt') }
+        self.l = Logger(console_log=True)
+        self.llm = CompletionClient(self.l)  # async, so chat keeps being read while a completion is pending
         self.speaker_bot = speaker_bot
         self.speaker_alias = speaker_alias
+        self.english = EnglishFilter()  # loaded once, from the local cache or nltk corpus
+        if speech is None and not speaker_bot:
+            speech = SpeechEngine(GoogleSynthesizer(), VlcPlayer(), Captions('output.txt'))
+        self.speech = speech  # synthesizes in the background, so the bot keeps reading chat while Sally talks
         super().__init__(token= creds.TWITCH_TOKEN, prefix='!', initial_channels=[creds.TWITCH_CHANNEL])
 
     async def event_ready(self):
         # Notify us when everything is ready!
         # We are logged in and ready to chat and use commands...
         print(f'Logged in as | {self.nick}')
+        if self.speech is not None:
+            self.speech.start()
 
     async def event_message(self, message):
         # Messages with echo set to True are messages sent by the bot...
@@ -38,11 +45,8 @@ class Bot(commands.Bot):
         if message.echo:
             return
 
-        # download the words corpus
-        nltk.download('words')
-
         # Check if the message contains english words
-        if not any(word in message.content for word in nltk.corpus.words.words()):
+        if not self.english.is_english(message.content):
             return
         
         # Check if the message is too long or short
@@ -58,7 +62,9 @@ class Bot(commands.Bot):
         Bot.conversation.append({ 'role': 'user', 'content': content })
         print(content)
 
-        response = gpt3_completion(Bot.conversation)
+        response = await self.llm.complete(self.system_prompt, Bot.conversation)
+        if response is None:
+            return
         print('DOGGIEBRO:' , response)
 
         if(Bot.conversation.count({ 'role': 'assistant', 'content': response }) == 0):
@@ -72,74 +78,10 @@ class Bot(commands.Bot):
             await self.handle_commands(message)
             return
         
-        client = texttospeech.TextToSpeechClient()
-
         response = message.content + "? " + response
-        ssml_text = '<speak>'
-        response_counter = 0
-        mark_array = []
-        for s in response.split(' '):
-            ssml_text += f'<mark name="{response_counter}"/>{s}'
-            mark_array.append(s)
-            response_counter += 1
-        ssml_text += '</speak>'
-
-        input_text = texttospeech.SynthesisInput(ssml = ssml_text)
-
-        # Note: the voice can also be specified by name.
-        # Names of voices can be retrieved with client.list_voices().
-        voice = texttospeech.VoiceSelectionParams(
-            language_code="en-GB",
-            name= "en-GB-Wavenet-B",
-            ssml_gender=texttospeech.SsmlVoiceGender.MALE,
-        )
-
-        audio_config = texttospeech.AudioConfig(    
-            audio_encoding=texttospeech.AudioEncoding.MP3,
-        )
-        
-
-        response = client.synthesize_speech(
-            request={"input": input_text, "voice": voice, "audio_config": audio_config, "enable_time_pointing": ["SSML_MARK"]}
-        )
-
-
-        # The response's audio_content is binary.
-        with open("output.mp3", "wb") as out:
-            out.write(response.audio_content)
+        await self.speech.say(response)  # returns once synthesis started, playback follows the previous answer
 
-        audio_file = os.path.dirname(__file__) + '/output.mp3'
-        media = vlc.MediaPlayer(audio_file)
-        media.play()
-        #playsound(audio_file, winsound.SND_ASYNC)
-
-
-        count = 0
-        current = 0
-        for i in range(len(response.timepoints)):
-            count += 1
-            current += 1
-            with open("output.txt", "a", encoding="utf-8") as out:
-                out.write(mark_array[int(response.timepoints[i].mark_name)] + " ")
-            if i != len(response.timepoints) - 1:
-                total_time = response.timepoints[i + 1].time_seconds
-                time.sleep(total_time - response.timepoints[i].time_seconds)
-            if current == 25:
-                    open('output.txt', 'w', encoding="utf-8").close()
-                    current = 0
-                    count = 0
-            elif count % 7 == 0:
-                with open("output.txt", "a", encoding="utf-8") as out:
-                    out.write("\n")
-        time.sleep(2)
-        open('output.txt', 'w').close()
-
-
-
-        # Print the contents of our message to console...
-        
         print('------------------------------------------------------')
-        os.remove(audio_file)
 
         # Since we have commands and are overriding the default `event_message`
         # We must let the bot know we want to handle and invoke our commands...
@@ -154,6 +96,10 @@ class Bot(commands.Bot):
         # Send a hello back!
         # Sending a reply back to the channel is easy... Below is an example.
         await ctx.send(f'Hello {ctx.author.name}!')
+
+    async def close(self):
+        await self.llm.close()
+        await super().close()
         
     async def send_to_speaker_bot(message:str, verbose = False) -> None:
         '''
@@ -0,0 +1,410 @@
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import signal
+import time
+from contextlib import asynccontextmanager
+
+import creds
+from logger import Logger
+from messages import CustomMessage
+from shards import SharedResources, ConsumerRegistry
+from speaker import SpeechPacer
+
+LINE_LIMIT = 1024 * 1024  # longest line either side accepts
+
+# Main process and workers exchange one JSON array per line over a local socket.
+#
+# main -> worker:
+#   ['message', shard, CustomMessage.to_wire()]  a Twitch message for the shard
+#   ['call', shard, method]                       reload_prompt, toggle_verbosity or clear_conv
+#   ['enabled', shard, enabled]                   streamer override of the redeem
+#   ['stream_info', shard, game, title]
+#   ['close', shard]
+#   ['ack', packet id, latency or null]           speaker.bot acknowledged a packet
+#   ['granted', token]                            the speech turn asked for is the worker's
+#
+# worker -> main:
+#   ['hello', worker index]
+#   ['speak', packet id, packet]                  to be sent to speaker.bot
+#   ['turn', token, shard]                        asks for the next speech turn of shard
+#   ['release', token]                            done speaking, or no longer waiting for the turn
+ALLOWED_CALLS = ('reload_prompt', 'toggle_verbosity', 'clear_conv')
+
+
+def encode(*fields) -> bytes:
+    return json.dumps(fields, separators=(',', ':')).encode() + b'\n'
+
+
+async def read_fields(reader: asyncio.StreamReader):
+    while line := await reader.readline():
+        yield json.loads(line)
+
+
+class WorkerLink:
+    """
+    The main process' end of the connection to one worker. What is sent
+    before the worker connected is kept and sent once it did.
+
+    A restarted worker counts its packet ids and turn tokens from 0 again,
+    so every connection gets a new generation and acks and grants meant for
+    an earlier one are dropped.
+    """
+
+    def __init__(self, index: int) -> None:
+        self.index = index
+        self.generation = 0
+        self.writer = None
+        self.backlog = []
+        self.releases = {}  # speech turn token -> event set once the worker releases it
+        self.tasks = set()
+
+    def send(self, *fields, generation: int = None):
+        if generation is not None and generation != self.generation:
+            return  # answers a worker that is gone
+        if self.writer is None:
+            self.backlog.append(encode(*fields))
+        elif not self.writer.is_closing():
+            self.writer.write(encode(*fields))
+
+    def attach(self, writer: asyncio.StreamWriter):
+        if self.writer is not None:
+            self.detach()  # a restarted worker may say hello before its predecessor's connection closed
+        self.writer = writer
+        for line in self.backlog:
+            writer.write(line)
+        self.backlog.clear()
+
+    def detach(self):
+        self.generation += 1
+        for release in self.releases.values():
+            release.set()
+        self.releases.clear()
+
+
+class RemoteConsumer:
+    """
+    Stands in for a QueueConsumer running in a worker process, so the Bot
+    can route to it like to a local one.
+    """
+
+    def __init__(self, spec: dict, shared: SharedResources, link: WorkerLink) -> None:
+        self.name = spec.get('name', 'sally')
+        self.channel = spec.get('channel') or creds.TWITCH_CHANNEL
+        self.shared = shared
+        self.link = link
+
+    async def put_message(self, message):
+        self.link.send('message', self.name, CustomMessage(message.author.name, message.content, 'Twitch').to_wire())
+
+    async def reload_prompt(self):
+        self.link.send('call', self.name, 'reload_prompt')
+
+    async def toggle_verbosity(self):
+        self.link.send('call', self.name, 'toggle_verbosity')
+
+    async def clear_conv(self):
+        self.link.send('call', self.name, 'clear_conv')
+
+    def set_enabled(self, enabled: bool):
+        self.link.send('enabled', self.name, enabled)
+
+    def set_stream_info(self, game, title):
+        self.link.send('stream_info', self.name, game, title)
+
+    async def close(self):
+        self.link.send('close', self.name)
+
+
+class WorkerPool:
+    """
+    Runs the consumers in worker processes, so their pre- and post-processing
+    uses more than one core. Every shard is assigned to exactly one worker
+    for the whole run, only that worker opens its conversation, memory,
+    ledger and exchange files. Each worker has its own completion client.
+
+    The main process keeps the Twitch connection, the speaker.bot connection
+    and the speech scheduler: workers send their packets to the main process,
+    and ask it for their turn before speaking an answer. A turn is only
+    granted once speaker.bot finished the previous answer.
+
+    Args:
+    - logger (Logger): Logger of the main process.
+    - specs (list): QueueConsumer keyword arguments per shard, without logger and shared.
+    - processes (int): Worker processes, one per core if None, never more than shards.
+    - shared (SharedResources): Resources of the main process, new ones if None.
+    - llm_factory: Module level function logger -> CompletionClient used by the workers, OpenAI if None.
+    - log_options (dict): Logger keyword arguments for the workers, file_URI gets the worker index added.
+    - chars_per_second (float): Speaking rate used for the estimates in the workers.
+    - completion_slots (int): Completions each worker may have in flight at once.
+    - metrics_port (int): Worker i serves its metrics on metrics_port + i, None for none.
+    - stats_interval (float): Seconds between metric summaries logged by every worker, None for none.
+    - restart_limit (int): Restarts of a worker within restart_window after which the pool fails instead.
+    - restart_window (float): Seconds over which the restarts of a worker are counted.
+    """
+
+    def __init__(self, logger: Logger, specs: list, processes: int = None, shared: SharedResources = None, llm_factory = None,
+                 log_options: dict = None, chars_per_second: float = 10.0, completion_slots: int = 4,
+                 metrics_port: int = None, stats_interval: float = None, restart_limit: int = 3,
+                 restart_window: float = 60.0) -> None:
+        self.l = logger
+        self.shared = shared if shared is not None else SharedResources(self.l)
+        processes = max(1, min(processes or os.cpu_count() or 1, len(specs)))
+        self.assignments = [specs[index::processes] for index in range(processes)]
+        self.links = [WorkerLink(index) for index in range(processes)]
+        self.consumers = ConsumerRegistry(self.l, self.shared)
+        for link, assigned in zip(self.links, self.assignments):
+            for spec in assigned:
+                self.consumers.add(RemoteConsumer(spec, self.shared, link))
+        self.options = {'llm_factory': llm_factory, 'log_options': log_options or {}, 'chars_per_second': chars_per_second,
+                        'completion_slots': completion_slots, 'metrics_port': metrics_port, 'stats_interval': stats_interval}
+        self.restart_limit = restart_limit
+        self.restart_window = restart_window
+        self.context = multiprocessing.get_context('spawn')  # behaves the same on every platform
+        self.processes = [None] * processes
+        self.server = None
+        self.port = None
+        self.closing = False
+
+    async def main(self):
+        self.server = await asyncio.start_server(self.serve_link, '127.0.0.1', 0, limit=LINE_LIMIT)
+        self.port = self.server.sockets[0].getsockname()[1]
+        await self.shared.start()
+        for index, assigned in enumerate(self.assignments):
+            self.spawn(index)
+            self.l.passing(f'Worker {index} runs {", ".join(spec.get("name", "sally") for spec in assigned)}')
+        try:
+            await asyncio.gather(*(self.watch(index) for index in range(len(self.processes))))
+        finally:
+            for process in self.processes:
+                if process is not None and process.is_alive():
+                    process.terminate()
+            self.server.close()
+            await self.server.wait_closed()
+            await self.shared.close()
+
+    def spawn(self, index: int):
+        process = self.context.Process(target=run_worker, args=(self.port, index, self.assignments[index], self.options),
+                                       name=f'consumer-worker-{index}', daemon=True)
+        process.start()
+        self.processes[index] = process
+
+    async def watch(self, index: int):
+        # a worker only exits on its own once close() finished its consumers, anything else is a crash.
+        # Its link keeps what is sent meanwhile and hands it to the replacement.
+        restarts = []
+        while True:
+            process = self.processes[index]
+            await asyncio.to_thread(process.join)
+            if self.closing:
+                return
+            now = time.monotonic()
+            restarts = [at for at in restarts if now - at < self.restart_window]
+            if len(restarts) >= self.restart_limit:
+                raise RuntimeError(f'Worker {index} died {len(restarts) + 1} times within {self.restart_window:.0f}s, '
+                                   f'last exit code {process.exitcode}')
+            restarts.append(now)
+            self.l.fail(f'Worker {index} died with exit code {process.exitcode}, restarting it')
+            self.spawn(index)
+
+    async def close(self):
+        self.closing = True
+        await self.consumers.close()  # the workers exit once all of their consumers finished
+
+    async def serve_link(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        link = None
+        try:
+            async for fields in read_fields(reader):
+                kind = fields[0]
+                if link is None:
+                    if kind != 'hello' or not isinstance(fields[1], int) or not 0 <= fields[1] < len(self.links):
+                        self.l.error(f'Rejecting a connection that did not introduce itself as a worker: {str(fields)[:80]}')
+                        return
+                    link = self.links[fields[1]]
+                    link.attach(writer)
+                elif kind == 'speak':
+                    await self.forward_speech(link, fields[1], fields[2])
+                elif kind == 'turn':
+                    token, shard = fields[1], fields[2]
+                    link.releases[token] = asyncio.Event()
+                    task = asyncio.create_task(self.grant_turn(link, link.generation, token, shard))
+                    link.tasks.add(task)
+                    task.add_done_callback(link.tasks.discard)
+                elif kind == 'release':
+                    release = link.releases.pop(fields[1], None)
+                    if release is not None:
+                        release.set()
+        except (ConnectionError, ValueError, LookupError, TypeError) as e:
+            self.l.error(f'Lost worker {link.index if link else "?"}: {e!r}')
+        finally:
+            if link is not None and link.writer is writer:
+                link.detach()
+                link.writer = None
+            writer.close()
+
+    async def forward_speech(self, link: WorkerLink, packet_id: int, data: dict):
+        generation = link.generation
+        self.shared.pacer.started(data.get('message', ''))
+        ack = await self.shared.speaker.send(data)
+        ack.add_done_callback(lambda ack: link.send('ack', packet_id, None if ack.cancelled() else ack.result(),
+                                                    generation=generation))
+
+    async def grant_turn(self, link: WorkerLink, generation: int, token: int, shard: str):
+        release = link.releases.get(token)
+        if release is None:
+            return
+        async with self.shared.speech.turn(shard):
+            if release.is_set():
+                return  # the worker gave up waiting
+            await self.shared.pacer.wait_idle()
+            link.send('granted', token, generation=generation)
+            await release.wait()
+
+
+class RemoteSpeaker:
+    """
+    Used by the consumers in a worker instead of a SpeakerConnection, packets
+    go to the main process, which sends them to speaker.bot.
+    """
+
+    def __init__(self, logger: Logger, writer: asyncio.StreamWriter) -> None:
+        self.l = logger
+        self.writer = writer
+        self.verbose = False
+        self.websocket = None
+        self.acks = {}  # packet id -> future resolved with the latency
+        self.ids = itertools.count()
+
+    def start(self):
+        pass
+
+    def add_listener(self, listener):
+        pass  # speaker.bot events are handled by the main process
+
+    async def send(self, data: dict) -> asyncio.Future:
+        packet_id = next(self.ids)
+        ack = asyncio.get_running_loop().create_future()
+        self.acks[packet_id] = ack
+        self.writer.write(encode('speak', packet_id, data))
+        await self.writer.drain()  # wait while the main process is behind instead of buffering without limit
+        return ack
+
+    def acknowledge(self, packet_id: int, latency: float):
+        ack = self.acks.pop(packet_id, None)
+        if ack is not None and not ack.done():
+            ack.set_result(latency)
+
+    async def close(self):
+        for ack in self.acks.values():
+            if not ack.done():
+                ack.set_result(None)
+        self.acks.clear()
+
+
+class RemotePacer(SpeechPacer):
+    # the main process only grants a speech turn once speaker.bot is idle,
+    # so in a worker the pacer just provides the estimates
+
+    def started(self, text: str):
+        pass
+
+    async def wait_idle(self):
+        pass
+
+
+class RemoteScheduler:
+    """
+    Used by the consumers in a worker instead of the speech FairScheduler,
+    turns are handed out by the main process over all workers.
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter) -> None:
+        self.writer = writer
+        self.pending = {}  # token -> future resolved once the turn is granted
+        self.tokens = itertools.count()
+
+    @asynccontextmanager
+    async def turn(self, shard: str):
+        token = next(self.tokens)
+        granted = asyncio.get_running_loop().create_future()
+        self.pending[token] = granted
+        self.writer.write(encode('turn', token, shard))
+        try:
+            await self.writer.drain()
+            await granted
+            yield
+        finally:
+            self.pending.pop(token, None)
+            if not self.writer.is_closing():
+                self.writer.write(encode('release', token))
+
+    def grant(self, token: int):
+        granted = self.pending.get(token)
+        if granted is not None and not granted.done():
+            granted.set_result(None)
+
+
+def run_worker(port: int, index: int, specs: list, options: dict):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C reaches the whole process group, the main process closes the workers
+    asyncio.run(serve_worker(port, index, specs, options))
+
+
+async def serve_worker(port: int, index: int, specs: list, options: dict):
+    from main import QueueConsumer  # main imports this module, so not at the top
+
+    log_options = dict(options['log_options'])
+    if log_options.get('file_URI'):
+        root, ext = os.path.splitext(log_options['file_URI'])
+        log_options['file_URI'] = f'{root}.worker{index}{ext}'
+    l = Logger(**log_options)
+    reader, writer = await asyncio.open_connection('127.0.0.1', port, limit=LINE_LIMIT)
+    speaker = RemoteSpeaker(l, writer)
+    speech = RemoteScheduler(writer)
+    factory = options['llm_factory']
+    metrics_port = options['metrics_port'] + index if options['metrics_port'] is not None else None
+    shared = SharedResources(l, llm=factory(l) if factory is not None else None, completion_slots=options['completion_slots'],
+                             metrics_port=metrics_port, stats_interval=options['stats_interval'], speaker=speaker,
+                             pacer=RemotePacer(l, chars_per_second=options['chars_per_second']), speech=speech)
+    consumers = ConsumerRegistry(l, shared, [QueueConsumer(l, shared=shared, **spec) for spec in specs])
+    writer.write(encode('hello', index))
+    running = asyncio.create_task(consumers.main())
+    commands = asyncio.create_task(receive_commands(reader, consumers, speaker, speech))
+    try:
+        await asyncio.wait({running, commands}, return_when=asyncio.FIRST_COMPLETED)
+        if not running.done():
+            l.warning(f'Worker {index} lost the main process, shutting down')
+            await consumers.close()
+            await running
+    finally:
+        commands.cancel()
+        writer.close()
+        l.close()
+
+
+async def receive_commands(reader: asyncio.StreamReader, consumers: ConsumerRegistry, speaker: RemoteSpeaker, speech: RemoteScheduler):
+    try:
+        async for fields in read_fields(reader):
+            kind = fields[0]
+            if kind == 'ack':
+                speaker.acknowledge(fields[1], fields[2])
+                continue
+            if kind == 'granted':
+                speech.grant(fields[1])
+                continue
+            consumer = consumers.shards.get(fields[1])
+            if consumer is None:
+                continue
+            if kind == 'message':
+                await consumer.accept(CustomMessage.from_wire(fields[2]))
+            elif kind == 'call' and fields[2] in ALLOWED_CALLS:
+                await getattr(consumer, fields[2])()
+            elif kind == 'enabled':
+                consumer.set_enabled(fields[2])
+            elif kind == 'stream_info':
+                consumer.set_stream_info(fields[2], fields[3])
+            elif kind == 'close':
+                await consumer.close()
+    except (ConnectionError, ValueError):
+        pass